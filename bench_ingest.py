@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark de la ingesta del webhook: compara el camino anterior
+(json estándar + `Update.de_json` para todo) con el actual (bytes crudos,
+`json_loads` acelerado y `UpdatePrefilter` antes de construir el `Update`).
+
+Importa `main`, así que necesita el mismo entorno que el bot; en local basta con
+FIRESTORE_EMULATOR_HOST y GOOGLE_CLOUD_PROJECT definidos:
+
+    FIRESTORE_EMULATOR_HOST=localhost:8081 GOOGLE_CLOUD_PROJECT=demo python bench_ingest.py
+"""
+
+import json
+import sys
+import timeit
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+import main
+
+
+def message(update_id: int, text: str, command: bool = False) -> dict:
+    payload = {
+        'message_id': update_id,
+        'date': 1700000000,
+        'chat': {'id': 1000 + update_id, 'type': 'private', 'first_name': 'Ana'},
+        'from': {'id': 1000 + update_id, 'is_bot': False, 'first_name': 'Ana', 'language_code': 'es'},
+        'text': text,
+    }
+    if command:
+        payload['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return payload
+
+
+def sample_updates() -> list:
+    """Mezcla aproximada del tráfico real: parte de las actualizaciones no las acepta ningún handler."""
+    updates = [
+        {'update_id': 1, 'message': message(1, '/start', command=True)},
+        {'update_id': 2, 'message': message(2, '/report', command=True)},
+        {'update_id': 3, 'message': message(3, 'La farola de mi calle no funciona')},
+        {'update_id': 4, 'message': message(4, '/unknown', command=True)},
+        {'update_id': 5, 'edited_message': message(5, 'texto editado')},
+        {'update_id': 6, 'callback_query': {
+            'id': '6', 'from': {'id': 1006, 'is_bot': False, 'first_name': 'Ana'},
+            'chat_instance': '6', 'data': 'confirm_feedback',
+            'message': message(6, 'Tu feedback es...'),
+        }},
+        {'update_id': 7, 'callback_query': {
+            'id': '7', 'from': {'id': 1007, 'is_bot': False, 'first_name': 'Ana'},
+            'chat_instance': '7', 'data': 'stale_button',
+            'message': message(7, 'Menú antiguo'),
+        }},
+        {'update_id': 8, 'my_chat_member': {
+            'chat': {'id': 1008, 'type': 'private', 'first_name': 'Ana'},
+            'from': {'id': 1008, 'is_bot': False, 'first_name': 'Ana'},
+            'date': 1700000000,
+            'old_chat_member': {'status': 'member', 'user': {'id': 1, 'is_bot': True, 'first_name': 'Bot'}},
+            'new_chat_member': {'status': 'kicked', 'until_date': 0,
+                                'user': {'id': 1, 'is_bot': True, 'first_name': 'Bot'}},
+        }},
+        {'update_id': 9, 'poll_answer': {
+            'poll_id': '9', 'user': {'id': 1009, 'is_bot': False, 'first_name': 'Ana'},
+            'option_ids': [0], 'option_persistent_ids': ['a'],
+        }},
+    ]
+    return [json.dumps(update).encode() for update in updates]
+
+
+def main_benchmark(rounds: int = 20000) -> None:
+    application = ApplicationBuilder().token('123456:BENCHMARK').updater(None).build()
+    main.register_handlers(application)
+    prefilter = main.UpdatePrefilter(application)
+    bot = application.bot
+    bodies = sample_updates()
+
+    def baseline() -> None:
+        for body in bodies:
+            Update.de_json(json.loads(body), bot)
+
+    def fast_path() -> None:
+        for body in bodies:
+            data = main.json_loads(body)
+            if prefilter.should_process(data):
+                Update.de_json(data, bot)
+
+    kept = sum(prefilter.should_process(main.json_loads(body)) for body in bodies)
+    per_round = len(bodies)
+    baseline_s = min(timeit.repeat(baseline, number=rounds // per_round, repeat=5))
+    fast_s = min(timeit.repeat(fast_path, number=rounds // per_round, repeat=5))
+    updates = (rounds // per_round) * per_round
+
+    print(f"backend JSON: {main.json_loads.__module__}", file=sys.stderr)
+    print(f"actualizaciones procesadas por el prefiltro: {kept}/{per_round}", file=sys.stderr)
+    print(f"antes:   {baseline_s / updates * 1e6:.2f} µs/actualización", file=sys.stderr)
+    print(f"ahora:   {fast_s / updates * 1e6:.2f} µs/actualización", file=sys.stderr)
+    print(f"mejora:  x{baseline_s / fast_s:.2f}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -4,8 +4,43 @@ import os
 import sys
 import logging
 import asyncio
+import atexit
+import contextvars
+import functools
+import queue
+import copy
+import secrets
+import signal
+import traceback
+from logging.handlers import QueueHandler, QueueListener
+import fcntl
+import socket
+import uuid
+import bisect
+import hashlib
+import math
+import subprocess
+import pickle
+import sqlite3
+import threading
+import httpx
+from collections.abc import MutableMapping
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from opentelemetry.sdk.trace.sampling import (
+    Decision,
+    ParentBased,
+    Sampler,
+    SamplingResult,
+    TraceIdRatioBased,
+)
+from opentelemetry.trace import SpanKind
 from dotenv import load_dotenv
 from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition
 from firebase_admin import credentials, initialize_app
 from telegram import (
     Update,
@@ -24,20 +59,25 @@ from telegram.ext import (
     filters,
     ConversationHandler,
     CallbackQueryHandler,
+    CallbackContext,
     ContextTypes,
 )
+from telegram.error import RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram import LabeledPrice, ShippingOption, ShippingQuery, ChosenInlineResult
 
-from datetime import datetime, time, date, timedelta
-import pytz
+from datetime import datetime, time, date, timedelta, timezone
+from zoneinfo import ZoneInfo
 from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
 import random
 import re
-from typing import Dict, List
+from typing import Dict, List, Optional
 import string
 import json
+from time import monotonic, sleep, thread_time
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 
 # Constantes de los estados del ConversationHandler
@@ -82,15 +122,153 @@ load_dotenv()
 TOKEN = os.environ.get("TOKEN")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
 
-# Habilitar el registro
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Habilitar el registro: los registros se encolan y un hilo aparte los escribe
+# en JSON, para que la E/S del logging no bloquee el bucle de eventos.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Muestreo por categoría, p. ej. "broadcast.recipient_error=0.01"
+LOG_SAMPLE_RATES = {
+    category.strip(): float(rate)
+    for category, rate in (
+        item.split('=', 1) for item in os.environ.get(
+            "LOG_SAMPLE_RATES", "broadcast.recipient_error=0.01"
+        ).split(',') if '=' in item
+    )
+}
+# Token para los endpoints de administración (/admin/...). Sin token, quedan desactivados.
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN")
+
+# Contexto de la actualización en curso, añadido a cada registro
+log_update_id = contextvars.ContextVar('log_update_id', default=None)
+log_user_id = contextvars.ContextVar('log_user_id', default=None)
+log_handler_name = contextvars.ContextVar('log_handler_name', default=None)
+
+
+class UpdateContextFilter(logging.Filter):
+    """Copia el contexto de la actualización al registro (se ejecuta en el hilo que registra)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.update_id = log_update_id.get()
+        record.user_id = log_user_id.get()
+        record.handler = log_handler_name.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Descarta una fracción de los registros de las categorías muestreadas (`extra={'category': ...}`)."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, 'category', None))
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por línea, con los campos que entiende Cloud Logging."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in ('update_id', 'user_id', 'handler', 'category'):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class StructuredQueueHandler(QueueHandler):
+    """
+    QueueHandler que no formatea en el hilo que registra: el QueueHandler estándar
+    mete el traceback en `message` y borra `exc_info`, y el JsonFormatter del
+    listener necesita ambos por separado.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Se interpola ahora: los argumentos podrían cambiar antes de que el listener lo procese
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+log_queue = queue.SimpleQueue()
+queue_handler = StructuredQueueHandler(log_queue)
+queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+queue_handler.addFilter(UpdateContextFilter())
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(JsonFormatter())
+log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+logging.basicConfig(format="%(message)s", level=LOG_LEVEL, handlers=[queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+
+def route_uvicorn_logs() -> None:
+    """
+    uvicorn configura sus loggers con StreamHandlers propios, síncronos y sin
+    propagar; se cambian por la cola para que sus líneas (incluido el access log
+    de cada webhook) salgan en JSON y no se escriban desde el bucle de eventos.
+    """
+    for name in ('uvicorn', 'uvicorn.access'):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = [queue_handler]
+        uvicorn_logger.propagate = False
+
+
+route_uvicorn_logs()
+
 # Instancia global de la aplicación de Telegram
 application = None
 
+# --- SERVICIO DE TIEMPO ---
+# Las fechas se guardan en UTC (Timestamps de Firestore, ordenables e indexables)
+# y se muestran en la zona local del bot. Latencias y caducidades de cachés se
+# miden siempre con `monotonic`, que no se ve afectado por cambios del reloj.
+
+LOCAL_TIMEZONE = ZoneInfo(os.environ.get("BOT_TIMEZONE", "Europe/Madrid"))
+_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+_TIME_PATTERN = re.compile(r"\d{1,2}:\d{2}")
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def to_local(moment: datetime) -> datetime:
+    return moment.astimezone(LOCAL_TIMEZONE)
+
+
+def parse_date(text: str) -> date:
+    """Fecha estricta AAAA-MM-DD. Lanza ValueError si no es válida."""
+    text = text.strip()
+    if not _DATE_PATTERN.fullmatch(text):
+        raise ValueError(f"Invalid date: {text!r}")
+    return date.fromisoformat(text)
+
+
+def parse_time(text: str) -> time:
+    """Hora estricta HH:MM (24 h). Lanza ValueError si no es válida."""
+    text = text.strip()
+    if not _TIME_PATTERN.fullmatch(text):
+        raise ValueError(f"Invalid time: {text!r}")
+    hours, minutes = map(int, text.split(':'))
+    return time(hours, minutes)
+
+
+def local_to_utc(day: date, at: time) -> datetime:
+    """Convierte una fecha y hora locales del bot en un instante UTC."""
+    return datetime.combine(day, at, tzinfo=LOCAL_TIMEZONE).astimezone(timezone.utc)
+
+
 # --- CONFIGURACIÓN DE FIRESTORE ---
 
 try:
@@ -108,15 +286,1335 @@ try:
     db = firestore.Client()
     logger.info("Cliente de Firestore inicializado correctamente.")
 except Exception as e:
-    logger.error(f"Error al inicializar Firestore: {e}")
+    logger.error("Error al inicializar Firestore: %s", e)
     sys.exit(1)
 
 
+# --- ELECCIÓN DE LÍDER PARA TAREAS EN SEGUNDO PLANO ---
+
+# Identificador único de esta instancia (revisión de Cloud Run + host + proceso)
+INSTANCE_ID = f"{os.environ.get('K_REVISION', 'local')}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+# "firestore" en producción, "file" para pruebas locales
+LEADER_LEASE_BACKEND = os.environ.get("LEADER_LEASE_BACKEND", "firestore")
+LEADER_LEASE_FILE = os.environ.get("LEADER_LEASE_FILE", "/tmp/reportebot_leases.json")
+LEADER_LEASE_TTL = float(os.environ.get("LEADER_LEASE_TTL", "30"))
+
+
+class FirestoreLeaseBackend:
+    """Lease con TTL guardado en un documento de Firestore (colección `leases`)."""
+
+    def __init__(self, client, collection: str = 'leases'):
+        self.collection = client.collection(collection)
+        self.client = client
+
+    def _try_acquire(self, name: str, holder: str, ttl: float) -> bool:
+        lease_ref = self.collection.document(name)
+
+        @firestore.transactional
+        def acquire_in_transaction(transaction) -> bool:
+            snapshot = lease_ref.get(transaction=transaction)
+            now = utc_now()
+            lease = snapshot.to_dict() if snapshot.exists else None
+            if lease and lease.get('holder') != holder and lease.get('expires_at') and lease['expires_at'] > now:
+                return False
+            transaction.set(lease_ref, {'holder': holder, 'expires_at': now + timedelta(seconds=ttl)})
+            return True
+
+        return acquire_in_transaction(self.client.transaction())
+
+    def _release(self, name: str, holder: str) -> None:
+        lease_ref = self.collection.document(name)
+
+        @firestore.transactional
+        def release_in_transaction(transaction) -> None:
+            snapshot = lease_ref.get(transaction=transaction)
+            if snapshot.exists and snapshot.get('holder') == holder:
+                transaction.delete(lease_ref)
+
+        release_in_transaction(self.client.transaction())
+
+    async def try_acquire(self, name: str, holder: str, ttl: float) -> bool:
+        """Adquiere o renueva el lease. Devuelve True si `holder` es el líder."""
+        return await asyncio.to_thread(self._try_acquire, name, holder, ttl)
+
+    async def release(self, name: str, holder: str) -> None:
+        await asyncio.to_thread(self._release, name, holder)
+
+
+class FileLeaseBackend:
+    """Sustituto local del backend de Firestore: leases en un fichero JSON con flock."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _update(self, mutate):
+        with open(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+') as lease_file:
+            fcntl.flock(lease_file, fcntl.LOCK_EX)
+            try:
+                lease_file.seek(0)
+                content = lease_file.read()
+                leases = json.loads(content) if content else {}
+                result = mutate(leases)
+                lease_file.seek(0)
+                lease_file.truncate()
+                json.dump(leases, lease_file)
+                lease_file.flush()
+                return result
+            finally:
+                fcntl.flock(lease_file, fcntl.LOCK_UN)
+
+    def _try_acquire(self, name: str, holder: str, ttl: float) -> bool:
+        def mutate(leases: Dict) -> bool:
+            # Tiempo de pared: el fichero se comparte entre procesos
+            now = utc_now().timestamp()
+            lease = leases.get(name)
+            if lease and lease['holder'] != holder and lease['expires_at'] > now:
+                return False
+            leases[name] = {'holder': holder, 'expires_at': now + ttl}
+            return True
+        return self._update(mutate)
+
+    def _release(self, name: str, holder: str) -> None:
+        def mutate(leases: Dict) -> None:
+            if leases.get(name, {}).get('holder') == holder:
+                del leases[name]
+        self._update(mutate)
+
+    async def try_acquire(self, name: str, holder: str, ttl: float) -> bool:
+        return await asyncio.to_thread(self._try_acquire, name, holder, ttl)
+
+    async def release(self, name: str, holder: str) -> None:
+        await asyncio.to_thread(self._release, name, holder)
+
+
+class LeaderElection:
+    """
+    Ejecuta cada tarea registrada una sola vez en toda la flota.
+    Cada tarea tiene su propio lease; el líder lo renueva cada ttl/3 y, si
+    deja de renovarlo, otra instancia lo toma como mucho tras `ttl` segundos.
+    """
+
+    def __init__(self, backend, holder: str, ttl: float = 30.0):
+        self.backend = backend
+        self.holder = holder
+        self.ttl = ttl
+        self._jobs: Dict[str, tuple] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def register(self, name: str, callback, interval: float) -> None:
+        """Registra `callback(application)` para ejecutarse cada `interval` segundos."""
+        self._jobs[name] = (callback, interval)
+
+    async def start(self, application) -> None:
+        for name, (callback, interval) in self._jobs.items():
+            self._tasks.append(asyncio.create_task(self._campaign(name, callback, interval, application)))
+        logger.info("Elección de líder iniciada para %d tareas (instancia %s).", len(self._jobs), self.holder)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for name in self._jobs:
+            try:
+                await self.backend.release(f"job:{name}", self.holder)
+            except Exception as e:
+                logger.warning("No se pudo liberar el lease de %s: %s", name, e)
+
+    async def _campaign(self, name: str, callback, interval: float, application) -> None:
+        lease_name = f"job:{name}"
+        renew_every = self.ttl / 3
+        next_run = 0.0
+        job_task = None
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    is_leader = await self.backend.try_acquire(lease_name, self.holder, self.ttl)
+                except Exception as e:
+                    logger.error("Error al renovar el lease de %s: %s", name, e)
+                    is_leader = False
+
+                if not is_leader and job_task and not job_task.done():
+                    # Hemos perdido el lease: otra instancia tomará el relevo
+                    logger.warning("Lease de %s perdido, cancelando la ejecución en curso.", name)
+                    job_task.cancel()
+
+                if is_leader and (job_task is None or job_task.done()) and loop.time() >= next_run:
+                    next_run = loop.time() + interval
+                    job_task = asyncio.create_task(self._run_job(name, callback, application))
+
+                await asyncio.sleep(min(renew_every, interval))
+        finally:
+            if job_task and not job_task.done():
+                job_task.cancel()
+
+    async def _run_job(self, name: str, callback, application) -> None:
+        try:
+            await callback(application)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Error en la tarea %s: %s", name, e)
+
+
+if LEADER_LEASE_BACKEND == "file":
+    lease_backend = FileLeaseBackend(LEADER_LEASE_FILE)
+else:
+    lease_backend = FirestoreLeaseBackend(db)
+
+leader_election = LeaderElection(lease_backend, INSTANCE_ID, ttl=LEADER_LEASE_TTL)
+
+
+# --- ENRUTADO DE ACTUALIZACIONES POR CHAT (SHARDING) ---
+
+# URLs internas de todas las instancias, separadas por comas. Vacío = modo desactivado.
+SHARD_PEERS = [peer.strip().rstrip('/') for peer in os.environ.get("SHARD_PEERS", "").split(',') if peer.strip()]
+# URL interna de esta instancia (debe aparecer en SHARD_PEERS)
+SHARD_SELF = os.environ.get("SHARD_SELF", "").rstrip('/')
+SHARD_FORWARD_TIMEOUT = float(os.environ.get("SHARD_FORWARD_TIMEOUT", "10"))
+SHARD_FORWARDED_HEADER = "X-Shard-Forwarded"
+SHARD_UPDATE_ID_HEADER = "X-Shard-Update-Id"
+# Segundos durante los que el propietario recuerda un update_id reenviado
+SHARD_DEDUP_TTL = float(os.environ.get("SHARD_DEDUP_TTL", "600"))
+
+# Resultados de ShardRouter.forward
+FORWARD_DELIVERED = 'delivered'
+# No se llegó a conectar: el cuerpo no salió de esta instancia y se puede procesar aquí
+FORWARD_UNREACHABLE = 'unreachable'
+# Timeout de lectura o 5xx: el propietario pudo recibirla, hay que dejar que Telegram reintente
+FORWARD_FAILED = 'failed'
+
+
+class HashRing:
+    """Anillo de hash consistente con nodos virtuales."""
+
+    def __init__(self, nodes: List[str], vnodes: int = 100):
+        self._ring = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def owner(self, key) -> str:
+        index = bisect.bisect(self._keys, self._hash(str(key))) % len(self._keys)
+        return self._ring[index][1]
+
+
+def extract_chat_id(data: Dict) -> Optional[int]:
+    """Obtiene el `effective_chat.id` del JSON de la actualización sin construir el `Update`."""
+    for payload in data.values():
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat.get('id')
+        sender = payload.get('from') or payload.get('user')
+        if sender:
+            return sender.get('id')
+    return None
+
+
+class ShardRouter:
+    """Reenvía cada actualización a la instancia propietaria de su chat."""
+
+    def __init__(self, peers: List[str], self_url: str):
+        self.enabled = len(peers) > 1 and self_url in peers
+        self.self_url = self_url
+        self.ring = HashRing(peers) if self.enabled else None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def owner_for(self, data: Dict) -> str:
+        chat_id = extract_chat_id(data)
+        if chat_id is None:
+            return self.self_url
+        return self.ring.owner(chat_id)
+
+    async def forward(self, owner: str, body: bytes, update_id: int) -> str:
+        """Reenvía el cuerpo original y devuelve uno de los resultados FORWARD_*."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=SHARD_FORWARD_TIMEOUT)
+        try:
+            response = await self._client.post(
+                f"{owner}/",
+                content=body,
+                headers={
+                    'Content-Type': 'application/json',
+                    SHARD_FORWARDED_HEADER: INSTANCE_ID,
+                    SHARD_UPDATE_ID_HEADER: str(update_id),
+                },
+            )
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            logger.warning("No se pudo conectar con %s para reenviar la actualización: %s", owner, e)
+            return FORWARD_UNREACHABLE
+        except httpx.HTTPError as e:
+            logger.warning("Reenvío de la actualización %s a %s sin respuesta: %s", update_id, owner, e)
+            return FORWARD_FAILED
+        if response.status_code >= 500:
+            logger.warning("El propietario %s respondió %d a la actualización %s.", owner, response.status_code, update_id)
+            return FORWARD_FAILED
+        return FORWARD_DELIVERED
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+shard_router = ShardRouter(SHARD_PEERS, SHARD_SELF)
+
+
+# --- ESTADO COMPARTIDO ENTRE PROCESOS (WORKERS DE UVICORN) ---
+
+# uvicorn usa WEB_CONCURRENCY como número de workers por defecto
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# "memory" (un solo proceso) o "sqlite" (compartido entre workers del contenedor)
+STATE_STORE = os.environ.get("STATE_STORE", "sqlite" if WEB_CONCURRENCY > 1 else "memory")
+STATE_STORE_PATH = os.environ.get("STATE_STORE_PATH", "/tmp/reportebot_state.sqlite3")
+# Segundos que un worker espera a que otro suelte el bloqueo de escritura de SQLite.
+# Cada escritura es una sola sentencia, así que la espera normal es de microsegundos;
+# si se agota, la actualización falla (y Telegram la reintenta) en vez de congelar el bucle.
+STATE_STORE_BUSY_TIMEOUT = float(os.environ.get("STATE_STORE_BUSY_TIMEOUT", "0.1"))
+WEBHOOK_LOCK_FILE = os.environ.get("WEBHOOK_LOCK_FILE", "/tmp/reportebot_webhook.lock")
+
+_MISSING = object()
+
+
+class MemoryStateStore:
+    """
+    Almacén clave-valor en memoria, válido para un único proceso. Las entradas con
+    `expires_at` (reloj `monotonic`) dejan de verse al caducar y se borran con `prune`.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, tuple]] = {}
+
+    @staticmethod
+    def _live(entry, now: float) -> bool:
+        return entry is not None and (entry[1] is None or entry[1] > now)
+
+    def get(self, namespace: str, key: str, default=None):
+        entry = self._data.get(namespace, {}).get(key)
+        return entry[0] if self._live(entry, monotonic()) else default
+
+    def set(self, namespace: str, key: str, value, expires_at: Optional[float] = None) -> None:
+        self._data.setdefault(namespace, {})[key] = (value, expires_at)
+
+    def delete(self, namespace: str, key: str) -> bool:
+        """Borra la clave. Devuelve True si existía."""
+        return self._data.get(namespace, {}).pop(key, None) is not None
+
+    def keys(self, namespace: str) -> List[str]:
+        now = monotonic()
+        return [key for key, entry in self._data.get(namespace, {}).items() if self._live(entry, now)]
+
+    def add_if_absent(self, namespace: str, key: str, value, expires_at: Optional[float] = None) -> bool:
+        """Guarda el valor solo si la clave no existe (o ha caducado). Devuelve True si lo ha guardado."""
+        entries = self._data.setdefault(namespace, {})
+        if self._live(entries.get(key), monotonic()):
+            return False
+        entries[key] = (value, expires_at)
+        return True
+
+    def prune(self, namespace: str) -> int:
+        """Borra las entradas caducadas del espacio de nombres y devuelve cuántas eran."""
+        now = monotonic()
+        entries = self._data.get(namespace, {})
+        expired = [key for key, entry in entries.items() if not self._live(entry, now)]
+        for key in expired:
+            del entries[key]
+        return len(expired)
+
+
+class SQLiteStateStore:
+    """
+    Almacén clave-valor en SQLite (modo WAL), compartido por todos los workers.
+    Cada operación es una única sentencia; `expires_at` usa `monotonic`, que en
+    Linux es común a todos los procesos del contenedor.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = STATE_STORE_BUSY_TIMEOUT):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "namespace TEXT, key TEXT, value BLOB, expires_at REAL, PRIMARY KEY (namespace, key))"
+        )
+        if 'expires_at' not in {row[1] for row in self._conn.execute("PRAGMA table_info(kv)")}:
+            try:
+                # Fichero creado por una versión anterior; otro worker puede estar migrándolo a la vez
+                self._conn.execute("ALTER TABLE kv ADD COLUMN expires_at REAL")
+            except sqlite3.OperationalError:
+                pass
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS kv_expiry ON kv (namespace, expires_at) "
+            "WHERE expires_at IS NOT NULL"
+        )
+
+    def _execute(self, sql: str, params: tuple) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def get(self, namespace: str, key: str, default=None):
+        row = self._execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, monotonic()),
+        ).fetchone()
+        return pickle.loads(row[0]) if row else default
+
+    def set(self, namespace: str, key: str, value, expires_at: Optional[float] = None) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, pickle.dumps(value), expires_at),
+        )
+
+    def delete(self, namespace: str, key: str) -> bool:
+        """Borra la clave. Devuelve True si existía."""
+        cursor = self._execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        return cursor.rowcount == 1
+
+    def keys(self, namespace: str) -> List[str]:
+        rows = self._execute(
+            "SELECT key FROM kv WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, monotonic()),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def add_if_absent(self, namespace: str, key: str, value, expires_at: Optional[float] = None) -> bool:
+        """Guarda el valor solo si la clave no existe (o ha caducado). Devuelve True si lo ha guardado."""
+        cursor = self._execute(
+            "INSERT INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE kv.expires_at IS NOT NULL AND kv.expires_at <= ?",
+            (namespace, key, pickle.dumps(value), expires_at, monotonic()),
+        )
+        return cursor.rowcount == 1
+
+    def prune(self, namespace: str) -> int:
+        """Borra las entradas caducadas del espacio de nombres y devuelve cuántas eran."""
+        cursor = self._execute(
+            "DELETE FROM kv WHERE namespace = ? AND expires_at <= ?", (namespace, monotonic())
+        )
+        return cursor.rowcount
+
+
+class StoredConversations(MutableMapping):
+    """Diccionario de estados de un ConversationHandler guardado en el almacén compartido."""
+
+    def __init__(self, store, namespace: str):
+        self._store = store
+        self._namespace = namespace
+
+    def __getitem__(self, key):
+        value = self._store.get(self._namespace, json.dumps(key), _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        self._store.set(self._namespace, json.dumps(key), value)
+
+    def __delitem__(self, key) -> None:
+        if not self._store.delete(self._namespace, json.dumps(key)):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return (tuple(json.loads(key)) for key in self._store.keys(self._namespace))
+
+    def __len__(self) -> int:
+        return len(self._store.keys(self._namespace))
+
+    def __contains__(self, key) -> bool:
+        return self._store.get(self._namespace, json.dumps(key), _MISSING) is not _MISSING
+
+
+class StoredUserData(StoredConversations):
+    """
+    `context.user_data` de un usuario en el almacén compartido, con una entrada por
+    clave: leer o escribir un campo es una sola sentencia, sin reescribir el resto.
+    """
+
+    def __init__(self, store, user_id: int):
+        super().__init__(store, f"user_data:{user_id}")
+
+    def __iter__(self):
+        return (json.loads(key) for key in self._store.keys(self._namespace))
+
+
+if STATE_STORE == "sqlite":
+    state_store = SQLiteStateStore(STATE_STORE_PATH)
+else:
+    state_store = MemoryStateStore()
+
+
+class SharedConversationHandler(ConversationHandler):
+    """ConversationHandler cuyo estado vive en `state_store` en lugar de en memoria del proceso."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._conversations = StoredConversations(state_store, f"conversation:{self.name}")
+
+
+class SharedCallbackContext(CallbackContext):
+    """CallbackContext cuyo `user_data` se lee y escribe en `state_store`."""
+
+    @property
+    def user_data(self):
+        if self._user_id is None:
+            return None
+        return StoredUserData(state_store, self._user_id)
+
+
+class ForwardedUpdateLog:
+    """
+    update_id reenviados por otras instancias que ya se han aceptado, para descartar
+    los que llegan de nuevo cuando Telegram reintenta tras un reenvío fallido.
+    Cada entrada caduca sola en el almacén; la purga es un único DELETE.
+    """
+
+    NAMESPACE = 'shard_updates'
+    PRUNE_EVERY = 1000
+
+    def __init__(self, store, ttl: float):
+        self.store = store
+        self.ttl = ttl
+        self._calls = 0
+
+    def first_seen(self, update_id: str) -> bool:
+        self._calls += 1
+        if self._calls % self.PRUNE_EVERY == 0:
+            self.store.prune(self.NAMESPACE)
+        return self.store.add_if_absent(self.NAMESPACE, update_id, True, expires_at=monotonic() + self.ttl)
+
+    def forget(self, update_id: str) -> None:
+        """Olvida una actualización cuyo procesamiento ha fallado, para aceptar el reintento."""
+        self.store.delete(self.NAMESPACE, update_id)
+
+
+forwarded_updates = ForwardedUpdateLog(state_store, SHARD_DEDUP_TTL)
+
+class ProcessLock:
+    """flock exclusivo que se mantiene mientras vive el proceso; el sistema lo libera si el proceso muere."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+# Solo un worker del contenedor registra el webhook en Telegram. El lock no caduca:
+# un proceso reiniciado lo vuelve a obtener en cuanto el anterior ha muerto.
+webhook_lock = ProcessLock(WEBHOOK_LOCK_FILE)
+
+
+# Segundos entre comprobaciones de los niveles de log fijados con /admin/log-level
+LOG_LEVEL_SYNC_INTERVAL = float(os.environ.get("LOG_LEVEL_SYNC_INTERVAL", "5"))
+
+
+class SharedLogLevels:
+    """
+    Niveles de log cambiados en caliente, guardados en `state_store` para que
+    /admin/log-level afecte a todos los workers del contenedor y no solo al que
+    atiende la petición. Cada worker los aplica al arrancar y cada pocos segundos.
+    """
+
+    NAMESPACE = 'log_levels'
+
+    def __init__(self, store, interval: float):
+        self.store = store
+        self.interval = interval
+        self._applied: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def set(self, name: Optional[str], level: str) -> None:
+        self.store.set(self.NAMESPACE, name or '', level)
+        self.apply()
+
+    def apply(self) -> None:
+        for name in self.store.keys(self.NAMESPACE):
+            level = self.store.get(self.NAMESPACE, name)
+            if level is not None and self._applied.get(name) != level:
+                logging.getLogger(name or None).setLevel(level)
+                self._applied[name] = level
+
+    def start(self) -> None:
+        self.apply()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.apply()
+            except Exception as e:
+                logger.error("Error al sincronizar los niveles de log: %s", e)
+
+
+shared_log_levels = SharedLogLevels(state_store, LOG_LEVEL_SYNC_INTERVAL)
+
+
+def run_local_shards(count: int, base_port: int = 8080) -> None:
+    """
+    Sustituto local de la flota: lanza `count` procesos uvicorn en puertos
+    consecutivos, todos con el mismo anillo. Útil para probar el reenvío.
+    """
+    peers = [f"http://127.0.0.1:{base_port + i}" for i in range(count)]
+    processes = []
+    for peer in peers:
+        env = dict(os.environ, SHARD_PEERS=','.join(peers), SHARD_SELF=peer,
+                   LEADER_LEASE_BACKEND="file")
+        port = peer.rsplit(':', 1)[1]
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', port],
+            env=env,
+        ))
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+# --- CACHÉ DE USUARIOS REGISTRADOS ---
+
+# Segundos que se recuerda que un ID no está registrado
+REGISTRATION_NEGATIVE_TTL = float(os.environ.get("REGISTRATION_NEGATIVE_TTL", "60"))
+REGISTRATION_WARM_PAGE_SIZE = 1000
+
+
+class RegistrationCache:
+    """
+    Conjunto de IDs registrados (los usuarios no se borran, así que no caducan)
+    y caché negativa con TTL corto para los IDs desconocidos. La negativa vive en
+    `state_store`: al registrarse se borra allí y la ven todos los workers del
+    contenedor; las demás instancias no reciben los chats de este (sharding).
+    """
+
+    NAMESPACE = 'unregistered_users'
+    PRUNE_EVERY = 1000
+
+    def __init__(self, store, negative_ttl: float):
+        self.store = store
+        self.negative_ttl = negative_ttl
+        self._registered: set = set()
+        self._records = 0
+
+    def lookup(self, user_id: int) -> Optional[bool]:
+        """True/False si la respuesta está en caché, None si hay que consultar Firestore."""
+        if user_id in self._registered:
+            return True
+        if self.store.get(self.NAMESPACE, str(user_id)) is not None:
+            return False
+        return None
+
+    def record(self, user_id: int, registered: bool) -> None:
+        if registered:
+            if user_id not in self._registered:
+                self.mark_registered(user_id)
+            return
+        self._records += 1
+        if self._records % self.PRUNE_EVERY == 0:
+            self.store.prune(self.NAMESPACE)
+        self.store.set(self.NAMESPACE, str(user_id), True, expires_at=monotonic() + self.negative_ttl)
+
+    def mark_registered(self, user_id: int) -> None:
+        self._registered.add(user_id)
+        self.store.delete(self.NAMESPACE, str(user_id))
+
+    def _scan_user_ids(self) -> List[int]:
+        user_ids = []
+        query = (
+            db.collection('users').select([FieldPath.document_id()])
+            .order_by(FieldPath.document_id()).limit(REGISTRATION_WARM_PAGE_SIZE)
+        )
+        last_doc = None
+        while True:
+            page = query.start_after(last_doc) if last_doc else query
+            docs = list(page.stream())
+            user_ids.extend(int(doc.id) for doc in docs if doc.id.lstrip('-').isdigit())
+            if len(docs) < REGISTRATION_WARM_PAGE_SIZE:
+                return user_ids
+            last_doc = docs[-1]
+
+    async def warm(self) -> None:
+        """Carga los IDs registrados con un escaneo paginado que solo lee las claves."""
+        try:
+            user_ids = await asyncio.to_thread(self._scan_user_ids)
+        except Exception as e:
+            logger.error("Error al precargar la caché de registro: %s", e)
+            return
+        self._registered.update(user_ids)
+        logger.info("Caché de registro precargada con %d usuarios.", len(user_ids))
+
+
+registration_cache = RegistrationCache(state_store, REGISTRATION_NEGATIVE_TTL)
+
+
+# --- TRAZAS (OPENTELEMETRY) ---
+
+# Fracción de actualizaciones cuyas trazas se exportan
+TRACE_SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", "0.1"))
+# "console", "file" o "none"
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "none")
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/reportebot_traces.jsonl")
+# Las actualizaciones más lentas que esto se registran con su árbol de spans completo
+SLOW_UPDATE_THRESHOLD_MS = float(os.environ.get("SLOW_UPDATE_THRESHOLD_MS", "2000"))
+
+
+class RecordUnsampledSampler(Sampler):
+    """
+    Muestreo por ratio para la exportación, pero los spans no muestreados se
+    siguen registrando (RECORD_ONLY) para que el log de lentitud los vea todos.
+    """
+
+    def __init__(self, ratio: float):
+        self._delegate = ParentBased(TraceIdRatioBased(ratio))
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        result = self._delegate.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if result.decision == Decision.DROP:
+            return SamplingResult(Decision.RECORD_ONLY, attributes, result.trace_state)
+        return result
+
+    def get_description(self) -> str:
+        return f"RecordUnsampled{{{self._delegate.get_description()}}}"
+
+
+class SlowUpdateSpanProcessor(SpanProcessor):
+    """Agrupa los spans por traza y, al cerrar la raíz, registra el árbol si supera el umbral."""
+
+    def __init__(self, threshold_ms: float):
+        self.threshold_ns = threshold_ms * 1_000_000
+        self._traces: Dict[int, List] = {}
+        self._lock = threading.Lock()
+
+    def on_end(self, span) -> None:
+        trace_id = span.context.trace_id
+        with self._lock:
+            if span.parent is not None:
+                self._traces.setdefault(trace_id, []).append(span)
+                return
+            spans = self._traces.pop(trace_id, [])
+        if span.end_time - span.start_time >= self.threshold_ns:
+            logger.warning("Actualización lenta:\n%s", self._format_tree(span, spans),
+                           extra={'category': 'trace.slow_update'})
+
+    @staticmethod
+    def _format_tree(root, spans: List) -> str:
+        children: Dict[int, List] = {}
+        for span in spans:
+            children.setdefault(span.parent.span_id, []).append(span)
+        lines = []
+
+        def walk(span, depth: int) -> None:
+            offset_ms = (span.start_time - root.start_time) / 1_000_000
+            duration_ms = (span.end_time - span.start_time) / 1_000_000
+            lines.append(f"{'  ' * depth}{span.name} +{offset_ms:.1f}ms {duration_ms:.1f}ms")
+            for child in sorted(children.get(span.context.span_id, []), key=lambda s: s.start_time):
+                walk(child, depth + 1)
+
+        walk(root, 0)
+        return '\n'.join(lines)
+
+    def shutdown(self) -> None:
+        self._traces.clear()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return True
+
+
+tracer_provider = TracerProvider(
+    sampler=RecordUnsampledSampler(TRACE_SAMPLE_RATIO),
+    resource=Resource.create({'service.name': 'reportebot', 'service.instance.id': INSTANCE_ID}),
+)
+tracer_provider.add_span_processor(SlowUpdateSpanProcessor(SLOW_UPDATE_THRESHOLD_MS))
+if TRACE_EXPORTER == "console":
+    tracer_provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter()))
+elif TRACE_EXPORTER == "file":
+    tracer_provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter(
+        out=open(TRACE_FILE, 'a'),
+        formatter=lambda span: span.to_json(indent=None) + os.linesep,
+    )))
+trace.set_tracer_provider(tracer_provider)
+tracer = trace.get_tracer(__name__)
+
+
+async def firestore_call(operation: str, func, *args):
+    """Ejecuta una operación síncrona de Firestore en un hilo, dentro de su propio span."""
+    with tracer.start_as_current_span(
+        f"firestore {operation}",
+        kind=SpanKind.CLIENT,
+        attributes={'db.system': 'firestore', 'db.operation': operation},
+    ):
+        return await asyncio.to_thread(func, *args)
+
+
+class TracedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest de PTB que abre un span por cada llamada a la Bot API."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # La URL contiene el token: solo se usa el nombre del método de la API
+        api_method = url.rsplit('/', 1)[-1]
+        with tracer.start_as_current_span(
+            f"telegram {api_method}", kind=SpanKind.CLIENT, attributes={'http.method': method}
+        ) as span:
+            status_code, payload = await super().do_request(url, method, *args, **kwargs)
+            span.set_attribute('http.status_code', status_code)
+            return status_code, payload
+
+# --- PERFILADO ---
+
+# Umbral a partir del cual se considera que algo ha bloqueado el bucle de eventos
+LOOP_LAG_THRESHOLD_MS = float(os.environ.get("LOOP_LAG_THRESHOLD_MS", "100"))
+PROFILE_MAX_SECONDS = 60
+
+
+class CPUTimedAwaitable:
+    """
+    Envuelve una corrutina y acumula solo el tiempo de CPU de sus propios pasos,
+    sin contar el de otras tareas que se ejecutan mientras está suspendida.
+    """
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.cpu = 0.0
+
+    def __await__(self):
+        generator = self.coro.__await__()
+        send, throw = None, None
+        while True:
+            started = thread_time()
+            try:
+                yielded = generator.throw(throw) if throw is not None else generator.send(send)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.cpu += thread_time() - started
+            try:
+                send, throw = (yield yielded), None
+            except BaseException as e:
+                send, throw = None, e
+
+
+class CPUStats:
+    """Tiempo de CPU y de pared acumulado por handler."""
+
+    def __init__(self):
+        self._stats: Dict[str, List[float]] = {}
+
+    def record(self, name: str, cpu: float, wall: float) -> None:
+        stats = self._stats.setdefault(name, [0, 0.0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += cpu
+        stats[2] += wall
+        stats[3] = max(stats[3], cpu)
+
+    def snapshot(self) -> Dict:
+        return {
+            name: {
+                'calls': calls,
+                'cpu_ms_total': round(cpu * 1000, 3),
+                'cpu_ms_avg': round(cpu * 1000 / calls, 3),
+                'cpu_ms_max': round(cpu_max * 1000, 3),
+                'wall_ms_avg': round(wall * 1000 / calls, 3),
+            }
+            for name, (calls, cpu, wall, cpu_max) in sorted(self._stats.items(), key=lambda item: -item[1][1])
+        }
+
+
+def _frame_label(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+class LoopLagMonitor:
+    """
+    Un latido en el bucle de eventos y un hilo vigilante: si el latido se
+    retrasa más del umbral, se registra la pila del hilo del bucle, que
+    señala el callback que lo está bloqueando.
+    """
+
+    def __init__(self, threshold_ms: float, interval: float = 0.05):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.loop_thread_id: Optional[int] = None
+        self.stalls = 0
+        self.max_lag_ms = 0.0
+        self.last_stall: Optional[str] = None
+        self._beat = monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        self._beat = monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True).start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._beat = monotonic()
+            await asyncio.sleep(self.interval)
+            lag_ms = (monotonic() - self._beat - self.interval) * 1000
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    def _watch(self) -> None:
+        reported = False
+        while not self._stop.wait(self.interval / 2):
+            blocked_for = monotonic() - self._beat - self.interval
+            if blocked_for <= self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            self.last_stall = ''.join(traceback.format_stack(frame)[-15:]) if frame else ''
+            logger.warning("Bucle de eventos bloqueado más de %.0f ms en:\n%s",
+                           blocked_for * 1000, self.last_stall, extra={'category': 'loop.blocked'})
+
+    def snapshot(self) -> Dict:
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'stalls': self.stalls,
+            'max_lag_ms': round(self.max_lag_ms, 3),
+            'last_stall': self.last_stall,
+        }
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> str:
+    """Perfilador por muestreo: devuelve las pilas del hilo en formato "collapsed" (flamegraph.pl, speedscope)."""
+    counts: Dict[str, int] = {}
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        if stack:
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        sleep(interval)
+    return '\n'.join(f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+
+handler_cpu_stats = CPUStats()
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_THRESHOLD_MS)
+profile_lock = asyncio.Lock()
+
+# --- INGESTA RÁPIDA DE ACTUALIZACIONES ---
+
+# orjson es opcional: si no está instalado se usa el json de la biblioteca estándar
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+MESSAGE_UPDATE_KEYS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'business_message', 'edited_business_message',
+)
+
+
+class UpdatePrefilter:
+    """
+    Decide con el JSON crudo si algún handler registrado podría aceptar la
+    actualización, para descartar las demás antes de construir el `Update`.
+    Es conservador: ante la duda, la actualización se procesa.
+    """
+
+    def __init__(self, application: Application):
+        self.commands: set = set()
+        self.callback_patterns: List = []
+        self.accept_all_callbacks = False
+        self.message_handlers: List = []
+        self.passthrough = False
+        self._collect(handler for group in application.handlers.values() for handler in group)
+        self.message_handlers_take_commands = self._probe_unknown_command(application.bot)
+
+    def _collect(self, handlers) -> None:
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                self._collect(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    self._collect(state_handlers)
+                self._collect(handler.fallbacks)
+            elif isinstance(handler, CommandHandler):
+                self.commands.update(handler.commands)
+            elif isinstance(handler, CallbackQueryHandler):
+                if isinstance(handler.pattern, str):
+                    self.callback_patterns.append(re.compile(handler.pattern))
+                elif isinstance(handler.pattern, re.Pattern):
+                    self.callback_patterns.append(handler.pattern)
+                else:
+                    self.accept_all_callbacks = True
+            elif isinstance(handler, MessageHandler):
+                self.message_handlers.append(handler)
+            else:
+                # Tipo de handler desconocido: no se descarta nada
+                self.passthrough = True
+
+    def _probe_unknown_command(self, bot) -> bool:
+        """Comprueba una sola vez si algún MessageHandler aceptaría un comando no registrado."""
+        probe = Update.de_json({
+            'update_id': 0,
+            'message': {
+                'message_id': 0, 'date': 0, 'chat': {'id': 0, 'type': 'private'},
+                'text': '/__probe__', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 10}],
+            },
+        }, bot)
+        return any(handler.check_update(probe) for handler in self.message_handlers)
+
+    def should_process(self, data: Dict) -> bool:
+        if self.passthrough:
+            return True
+        for key in MESSAGE_UPDATE_KEYS:
+            message = data.get(key)
+            if message is None:
+                continue
+            command = self._peek_command(message)
+            if command is None:
+                return bool(self.message_handlers)
+            return command in self.commands or self.message_handlers_take_commands
+        callback_query = data.get('callback_query')
+        if callback_query is not None:
+            if self.accept_all_callbacks:
+                return True
+            callback_data = callback_query.get('data')
+            return callback_data is not None and any(p.match(callback_data) for p in self.callback_patterns)
+        return False
+
+    @staticmethod
+    def _peek_command(message: Dict) -> Optional[str]:
+        """Nombre del comando (en minúsculas y sin @bot) si el mensaje empieza por uno."""
+        entities = message.get('entities')
+        if not entities or entities[0].get('type') != 'bot_command' or entities[0].get('offset') != 0:
+            return None
+        text = message.get('text', '')
+        return text[1:entities[0]['length']].split('@', 1)[0].lower()
+
+
+update_prefilter: Optional[UpdatePrefilter] = None
+
+# --- ANALÍTICA ---
+
+# Segundos entre volcados de los contadores a Firestore
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", "60"))
+ANALYTICS_MAX_DAYS = 90
+# Nombres de los estados de cada conversación (los valores numéricos se repiten entre conversaciones)
+CONVERSATION_STATE_NAMES = {
+    'register': ('REGISTER_NAME', 'REGISTER_EMAIL'),
+    'report': ('REPORT_DETAILS',),
+    'admin': ('ADMIN_MENU', 'ADMIN_BROADCAST'),
+    'location': ('GET_LOCATION',),
+    'event': ('EVENT_NAME', 'EVENT_DATE', 'EVENT_TIME', 'EVENT_LOCATION', 'EVENT_DESCRIPTION'),
+    'poll': ('POLL_QUESTION', 'POLL_OPTIONS_INPUT'),
+    'feedback': ('FEEDBACK_TEXT', 'FEEDBACK_CONFIRMATION'),
+    'bug': ('BUG_DESCRIPTION', 'BUG_REPRODUCE', 'BUG_CONTACT', 'BUG_CONFIRMATION'),
+    'contact': ('CONTACT_NAME', 'CONTACT_EMAIL', 'CONTACT_MESSAGE', 'CONTACT_CONFIRMATION'),
+    'subscribe': ('SUBSCRIBE_CONFIRMATION',),
+    'unsubscribe': ('UNSUBSCRIBE_CONFIRMATION',),
+    'check_status': ('CHECK_STATUS_ID',),
+}
+# Paso especial para los entry points de una conversación
+FUNNEL_ENTRY = 'entry'
+
+
+class HyperLogLog:
+    """Estimador de cardinalidad de 4 KiB (p=12, error típico ~1,6 %); dos HLL se combinan con max()."""
+
+    def __init__(self, precision: int = 12, registers: Optional[bytes] = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    def add(self, value: str) -> None:
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # Corrección para cardinalidades pequeñas (linear counting)
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+
+def _nest(fields: Dict[str, object]) -> Dict:
+    """Convierte {"a.b": 1} en {"a": {"b": 1}}, para set(merge=True)."""
+    nested: Dict = {}
+    for path, value in fields.items():
+        *parents, leaf = path.split('.')
+        node = nested
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+    return nested
+
+
+class AnalyticsRollup:
+    """
+    Agregados diarios en memoria (usuarios activos con HyperLogLog, uso de comandos,
+    embudos por estado de conversación y altas/bajas), volcados periódicamente al
+    documento analytics_daily/<día>: los contadores con Increment y el HLL fusionado
+    en una transacción, de modo que varias instancias pueden escribir a la vez.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._visitors: Dict[str, HyperLogLog] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    @staticmethod
+    def _today() -> str:
+        return to_local(utc_now()).date().isoformat()
+
+    def increment(self, field: str, amount: int = 1) -> None:
+        counters = self._counters.setdefault(self._today(), {})
+        counters[field] = counters.get(field, 0) + amount
+
+    def record_user(self, user_id: int) -> None:
+        self._visitors.setdefault(self._today(), HyperLogLog()).add(str(user_id))
+
+    def record_handler(self, update: Update, callback_name: str, result, command: bool, funnel) -> None:
+        """Anota una invocación de handler: usuario activo, comando y transición del embudo."""
+        if update.effective_user:
+            self.record_user(update.effective_user.id)
+        if command and update.effective_message and update.effective_message.text:
+            name = update.effective_message.text.split()[0].lstrip('/').split('@')[0].lower()
+            self.increment(f"commands.{name}")
+        if funnel is None or result is None:
+            return
+        conversation, step, state_names = funnel
+        if result == ConversationHandler.END:
+            self.increment(f"funnel.{conversation}.end.{callback_name}")
+            return
+        if step == FUNNEL_ENTRY:
+            self.increment(f"funnel.{conversation}.start")
+        if result != step:
+            self.increment(f"funnel.{conversation}.{state_names.get(result, f'state_{result}')}")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Sin cancelar: un volcado en curso termina antes del volcado final
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    async def flush(self) -> None:
+        counters, visitors = self._counters, self._visitors
+        if not counters and not visitors:
+            return
+        self._counters, self._visitors = {}, {}
+        try:
+            failed_days = await firestore_call('analytics.flush', self._write, counters, visitors)
+        except Exception as e:
+            logger.error("Error al volcar la analítica; se reintentará: %s", e)
+            failed_days = counters.keys() | visitors.keys()
+        # Solo se devuelven los deltas de los días que no llegaron a escribirse
+        for day in failed_days:
+            for field, amount in counters.get(day, {}).items():
+                self._counters.setdefault(day, {})
+                self._counters[day][field] = self._counters[day].get(field, 0) + amount
+            if day in visitors:
+                self._visitors.setdefault(day, HyperLogLog()).merge(visitors[day])
+
+    @staticmethod
+    def _write(counters: Dict[str, Dict[str, int]], visitors: Dict[str, HyperLogLog]) -> List[str]:
+        """Escribe cada día en su propia transacción y devuelve los días que fallaron."""
+        failed_days = []
+        for day in counters.keys() | visitors.keys():
+            day_ref = db.collection('analytics_daily').document(day)
+            update = {field: firestore.Increment(amount) for field, amount in counters.get(day, {}).items()}
+            update['day'] = day
+            hll = visitors.get(day)
+
+            @firestore.transactional
+            def apply(transaction):
+                if hll is not None:
+                    snapshot = day_ref.get(transaction=transaction)
+                    merged = HyperLogLog(registers=(snapshot.to_dict() or {}).get('dau_registers'))
+                    merged.merge(hll)
+                    update['dau_registers'] = bytes(merged.registers)
+                    update['dau'] = merged.count()
+                transaction.set(day_ref, _nest(update), merge=True)
+
+            try:
+                apply(db.transaction())
+            except Exception as e:
+                logger.error("Error al volcar la analítica del %s; se reintentará: %s", day, e)
+                failed_days.append(day)
+        return failed_days
+
+
+def _read_rollups(days: int) -> Dict:
+    """Lee los últimos `days` documentos diarios por ID, sin recorrer colecciones."""
+    today = to_local(utc_now()).date()
+    day_ids = [(today - timedelta(days=offset)).isoformat() for offset in range(days - 1, -1, -1)]
+    refs = [db.collection('analytics_daily').document(day_id) for day_id in day_ids]
+    rollups = {snapshot.id: snapshot.to_dict() for snapshot in db.get_all(refs) if snapshot.exists}
+
+    visitors = HyperLogLog()
+    commands: Dict[str, int] = {}
+    funnels: Dict[str, Dict] = {}
+    daily = []
+    net_subscribers = 0
+    for day_id in day_ids:
+        rollup = rollups.get(day_id, {})
+        if rollup.get('dau_registers'):
+            visitors.merge(HyperLogLog(registers=rollup['dau_registers']))
+        for name, amount in rollup.get('commands', {}).items():
+            commands[name] = commands.get(name, 0) + amount
+        for conversation, steps in rollup.get('funnel', {}).items():
+            totals = funnels.setdefault(conversation, {})
+            for step, amount in steps.items():
+                if step == 'end':
+                    ends = totals.setdefault('end', {})
+                    for callback_name, ended in amount.items():
+                        ends[callback_name] = ends.get(callback_name, 0) + ended
+                else:
+                    totals[step] = totals.get(step, 0) + amount
+        subscribers = rollup.get('subscribers', {})
+        net_subscribers += subscribers.get('joined', 0) - subscribers.get('left', 0)
+        daily.append({
+            'day': day_id,
+            'dau': rollup.get('dau', 0),
+            'registered': rollup.get('users', {}).get('registered', 0),
+            'subscribers_joined': subscribers.get('joined', 0),
+            'subscribers_left': subscribers.get('left', 0),
+            'subscribers_net_cumulative': net_subscribers,
+        })
+
+    # Conversión de cada paso respecto a los embudos iniciados
+    for totals in funnels.values():
+        started = totals.get('start', 0)
+        if started:
+            totals['conversion'] = {
+                step: round(amount / started, 3)
+                for step, amount in totals.items() if step not in ('start', 'end', 'conversion')
+            }
+    return {
+        'from': day_ids[0],
+        'to': day_ids[-1],
+        'distinct_users': visitors.count(),
+        'commands': dict(sorted(commands.items(), key=lambda item: -item[1])),
+        'funnels': funnels,
+        'daily': daily,
+    }
+
+
+analytics = AnalyticsRollup(ANALYTICS_FLUSH_INTERVAL)
+
+
+# --- INSTRUMENTACIÓN DE HANDLERS ---
+
+def instrumented_callback(callback, command: bool = False, funnel: Optional[tuple] = None):
+    """
+    Envuelve el callback de un handler para anotar el contexto de la actualización.
+    `funnel` es (conversación, paso, nombres de estado) para contar las transiciones.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        token = log_handler_name.set(callback.__name__)
+        timed = CPUTimedAwaitable(callback(update, context))
+        started = monotonic()
+        try:
+            with tracer.start_as_current_span(f"handler {callback.__name__}"):
+                result = await timed
+            analytics.record_handler(update, callback.__name__, result, command, funnel)
+            return result
+        finally:
+            handler_cpu_stats.record(callback.__name__, timed.cpu, monotonic() - started)
+            log_handler_name.reset(token)
+    return wrapper
+
+
+def instrument_handlers(handlers, conversation: Optional[str] = None, step=None, state_names=None) -> None:
+    """Instrumenta todos los handlers, incluidos los de dentro de cada ConversationHandler."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            if handler.name is None:
+                instrument_handlers(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    instrument_handlers(state_handlers)
+                instrument_handlers(handler.fallbacks)
+                continue
+            names = {globals()[name]: name for name in CONVERSATION_STATE_NAMES.get(handler.name, ())}
+            instrument_handlers(handler.entry_points, handler.name, FUNNEL_ENTRY, names)
+            for state, state_handlers in handler.states.items():
+                instrument_handlers(state_handlers, handler.name, state, names)
+            instrument_handlers(handler.fallbacks, handler.name, None, names)
+        elif not hasattr(handler.callback, '__wrapped__'):
+            funnel = (conversation, step, state_names) if conversation else None
+            handler.callback = instrumented_callback(
+                handler.callback, command=isinstance(handler, CommandHandler), funnel=funnel
+            )
+
+
 # --- FUNCIONES DE GESTIÓN DE USUARIOS Y REPORTES ---
 
 async def get_user_data(user_id: int) -> Dict:
     user_ref = db.collection('users').document(str(user_id))
-    user_doc = await asyncio.to_thread(user_ref.get)
+    user_doc = await firestore_call('users.get', user_ref.get)
+    registration_cache.record(user_id, user_doc.exists)
     return user_doc.to_dict() if user_doc.exists else None
 
 async def is_admin(user_id: int) -> bool:
@@ -124,15 +1622,752 @@ async def is_admin(user_id: int) -> bool:
     return user_data and user_data.get('is_admin', False)
 
 async def check_user_registered(user_id: int) -> bool:
+    cached = registration_cache.lookup(user_id)
+    if cached is not None:
+        return cached
+
     user_ref = db.collection('users').document(str(user_id))
-    user_doc = await asyncio.to_thread(user_ref.get)
+    user_doc = await firestore_call('users.get', user_ref.get)
+    registration_cache.record(user_id, user_doc.exists)
     return user_doc.exists
 
-async def add_report_to_db(report_data: Dict, user_id: int):
+async def add_report_to_db(report_data: Dict, user_id: int) -> str:
     reports_ref = db.collection('reports')
     report_data['user_id'] = user_id
-    report_data['timestamp'] = datetime.now(pytz.timezone('Europe/Madrid'))
-    await asyncio.to_thread(reports_ref.add, report_data)
+    report_data['status'] = REPORT_STATUS_PENDING
+    report_data['timestamp'] = utc_now()
+    _, report_ref = await firestore_call('reports.add', reports_ref.add, report_data)
+    return report_ref.id
+
+# --- CICLO DE VIDA DE LOS REPORTES Y NOTIFICACIONES ---
+
+REPORT_STATUS_PENDING = 'Pendiente'
+REPORT_STATUS_IN_REVIEW = 'En revisión'
+REPORT_STATUS_RESOLVED = 'Resuelto'
+# Transiciones permitidas desde cada estado
+REPORT_TRANSITIONS = {
+    REPORT_STATUS_PENDING: {REPORT_STATUS_IN_REVIEW, REPORT_STATUS_RESOLVED},
+    REPORT_STATUS_IN_REVIEW: {REPORT_STATUS_RESOLVED},
+    REPORT_STATUS_RESOLVED: set(),
+}
+# Clave de MESSAGES con el nombre mostrado de cada estado
+REPORT_STATUS_KEYS = {
+    REPORT_STATUS_PENDING: 'status_pending',
+    REPORT_STATUS_IN_REVIEW: 'status_in_review',
+    REPORT_STATUS_RESOLVED: 'status_resolved',
+}
+# Alias aceptados por /set_status
+REPORT_STATUS_ALIASES = {
+    'pendiente': REPORT_STATUS_PENDING,
+    'revision': REPORT_STATUS_IN_REVIEW,
+    'en_revision': REPORT_STATUS_IN_REVIEW,
+    'resuelto': REPORT_STATUS_RESOLVED,
+}
+# Límite de operaciones por lote de escritura de Firestore
+FIRESTORE_BATCH_SIZE = 500
+# Reintentos de un lote cuyos reportes cambiaron entre la lectura y la escritura
+STATUS_UPDATE_ATTEMPTS = 3
+# Segundos durante los que se agrupan los cambios de un mismo usuario
+STATUS_NOTIFY_WINDOW = float(os.environ.get("STATUS_NOTIFY_WINDOW", "10"))
+# Mensajes por segundo como máximo hacia la Bot API, sumando todos los workers del contenedor
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", "25"))
+OUTBOUND_MAX_ATTEMPTS = 3
+
+
+class OutboundQueue:
+    """Cola de mensajes salientes enviados a ritmo limitado, respetando los RetryAfter de Telegram."""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1 / rate_per_second
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._bot = None
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, chat_id: int, text: str) -> None:
+        self._queue.put_nowait((chat_id, text))
+
+    async def _run(self) -> None:
+        while True:
+            chat_id, text = await self._queue.get()
+            try:
+                await self._send(chat_id, text)
+            except Exception as e:
+                # Un error inesperado no debe detener la cola para el resto de mensajes
+                logger.exception("Error inesperado al enviar notificación a %s: %s", chat_id, e,
+                                 extra={'category': 'outbound.error'})
+            finally:
+                self._queue.task_done()
+            await asyncio.sleep(self.interval)
+
+    async def _send(self, chat_id: int, text: str) -> None:
+        for _ in range(OUTBOUND_MAX_ATTEMPTS):
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text)
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+            except TelegramError as e:
+                logger.error("Error al enviar notificación a %s: %s", chat_id, e,
+                             extra={'category': 'outbound.error'})
+                return
+        logger.error("Notificación a %s descartada tras %d RetryAfter seguidos.", chat_id, OUTBOUND_MAX_ATTEMPTS,
+                     extra={'category': 'outbound.error'})
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Intenta vaciar la cola antes de detener el envío."""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Se descartan %d mensajes pendientes.", self._queue.qsize())
+        self._task.cancel()
+        self._task = None
+
+
+class StatusNotifier:
+    """Agrupa los cambios de estado de un mismo usuario dentro de una ventana en un solo mensaje."""
+
+    def __init__(self, outbound: OutboundQueue, window: float):
+        self.outbound = outbound
+        self.window = window
+        self._pending: Dict[int, Dict[str, str]] = {}
+        self._locales: Dict[int, Optional[str]] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+
+    def notify(self, user_id: int, report_id: str, status: str, locale: Optional[str] = None) -> None:
+        changes = self._pending.setdefault(user_id, {})
+        if not changes:
+            loop = asyncio.get_running_loop()
+            self._timers[user_id] = loop.call_later(self.window, self._flush_user, user_id)
+        changes[report_id] = status
+        self._locales[user_id] = locale
+
+    def _flush_user(self, user_id: int) -> None:
+        self._timers.pop(user_id, None)
+        changes = self._pending.pop(user_id, None)
+        locale = self._locales.pop(user_id, None)
+        if not changes:
+            return
+        if len(changes) == 1:
+            report_id, status = next(iter(changes.items()))
+            text = messages.render(locale, 'status_changed_one', report_id=report_id,
+                                   status=messages.status(locale, status))
+        else:
+            lines = '\n'.join(f"- {report_id}: {messages.status(locale, status)}" for report_id, status in changes.items())
+            text = messages.render(locale, 'status_changed_many', count=len(changes), lines=lines)
+        self.outbound.put(user_id, text)
+
+    def flush_all(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        for user_id in list(self._pending):
+            self._flush_user(user_id)
+
+
+# Cada worker tiene su propia cola: el límite se reparte entre todos
+outbound_queue = OutboundQueue(OUTBOUND_RATE / WEB_CONCURRENCY)
+status_notifier = StatusNotifier(outbound_queue, STATUS_NOTIFY_WINDOW)
+
+
+def _apply_status_chunk(chunk: List[str], new_status: str):
+    """
+    Valida y escribe un lote. Cada escritura exige que el reporte no haya cambiado
+    desde que se leyó, para que dos cambios simultáneos no se salten REPORT_TRANSITIONS.
+    """
+    refs = [db.collection('reports').document(report_id) for report_id in chunk]
+    batch = db.batch()
+    pending, skipped = [], []
+    for snapshot in db.get_all(refs):
+        report = snapshot.to_dict() if snapshot.exists else None
+        current = report.get('status', REPORT_STATUS_PENDING) if report else None
+        if report is None or new_status not in REPORT_TRANSITIONS.get(current, set()):
+            skipped.append(snapshot.id)
+            continue
+        batch.update(
+            snapshot.reference,
+            {'status': new_status, 'status_updated_at': firestore.SERVER_TIMESTAMP},
+            option=db.write_option(last_update_time=snapshot.update_time),
+        )
+        pending.append((snapshot.id, report.get('user_id'), report.get('locale')))
+    if pending:
+        batch.commit()
+    return pending, skipped
+
+
+def _apply_status_changes(report_ids: List[str], new_status: str) -> Dict:
+    """Lee los reportes, valida las transiciones y escribe los cambios en lotes."""
+    updated, skipped = [], []
+    for start in range(0, len(report_ids), FIRESTORE_BATCH_SIZE):
+        chunk = report_ids[start:start + FIRESTORE_BATCH_SIZE]
+        for attempt in range(STATUS_UPDATE_ATTEMPTS):
+            try:
+                pending, chunk_skipped = _apply_status_chunk(chunk, new_status)
+                break
+            except FailedPrecondition:
+                # Otro cambio se adelantó: se relee el lote y se validan de nuevo las transiciones
+                logger.info("Conflicto al cambiar estados (intento %d), se reintenta el lote.", attempt + 1)
+        else:
+            pending, chunk_skipped = [], chunk
+        updated.extend(pending)
+        skipped.extend(chunk_skipped)
+    return {'updated': updated, 'skipped': skipped}
+
+
+async def update_report_statuses(report_ids: List[str], new_status: str) -> Dict:
+    """Cambia el estado de varios reportes y avisa a quienes los crearon."""
+    result = await firestore_call('reports.batch_update', _apply_status_changes, report_ids, new_status)
+    for report_id, user_id, locale in result['updated']:
+        if user_id is not None:
+            status_notifier.notify(user_id, report_id, new_status, locale)
+    logger.info("Estado '%s' aplicado a %d reportes (%d omitidos).",
+                new_status, len(result['updated']), len(result['skipped']))
+    return {'updated': [report_id for report_id, _, _ in result['updated']], 'skipped': result['skipped']}
+
+# --- APAGADO ORDENADO ---
+
+# Segundos para terminar el trabajo en curso tras SIGTERM (Cloud Run concede 10)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "8"))
+# Espera antes de cerrar el servidor para que el balanceador deje de enrutar (0 en Cloud Run)
+SHUTDOWN_GRACE_PERIOD = float(os.environ.get("SHUTDOWN_GRACE_PERIOD", "0"))
+# Plazo de uvicorn (--timeout-graceful-shutdown) para las peticiones en curso. Uvicorn solo
+# ejecuta el cierre del lifespan después, así que debe ser menor que SHUTDOWN_DRAIN_TIMEOUT
+SHUTDOWN_HTTP_TIMEOUT = int(os.environ.get("SHUTDOWN_HTTP_TIMEOUT", "6"))
+
+
+class ShutdownCoordinator:
+    """
+    Fases del proceso: starting -> ready -> draining -> stopped. Al drenar se
+    rechazan los webhooks con 503 (Telegram los reintenta contra otra revisión)
+    y se espera, con un plazo, a las actualizaciones y trabajos en curso.
+    """
+
+    STARTING, READY, DRAINING, STOPPED = 'starting', 'ready', 'draining', 'stopped'
+
+    def __init__(self, drain_timeout: float, grace_period: float):
+        self.drain_timeout = drain_timeout
+        self.grace_period = grace_period
+        self.phase = self.STARTING
+        self._deadline: Optional[float] = None
+        self._in_flight: set = set()
+        self._drain_callbacks: List = []
+        self._drain_task: Optional[asyncio.Task] = None
+
+    @property
+    def accepting(self) -> bool:
+        return self.phase == self.READY
+
+    @property
+    def stopping(self) -> bool:
+        return self.phase in (self.DRAINING, self.STOPPED)
+
+    def mark_ready(self) -> None:
+        self.phase = self.READY
+
+    def mark_stopped(self) -> None:
+        self.phase = self.STOPPED
+
+    def on_drain(self, callback) -> None:
+        """Registra `await callback()` para vaciar datos en cuanto empieza el drenaje, sin esperar a uvicorn."""
+        self._drain_callbacks.append(callback)
+
+    def begin_drain(self) -> None:
+        if self.stopping:
+            return
+        self.phase = self.DRAINING
+        self._deadline = monotonic() + self.drain_timeout
+        logger.info("Drenando: se rechazan nuevas actualizaciones (%d tareas en curso).", len(self._in_flight))
+        if self._drain_callbacks:
+            self._drain_task = asyncio.get_running_loop().create_task(self._run_drain_callbacks())
+
+    async def _run_drain_callbacks(self) -> None:
+        for callback in self._drain_callbacks:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error("Error al vaciar datos al empezar el apagado: %s", e)
+
+    def remaining(self) -> float:
+        """Segundos que quedan del plazo de drenaje."""
+        if self._deadline is None:
+            return self.drain_timeout
+        return max(self._deadline - monotonic(), 0.0)
+
+    def track(self, task: asyncio.Task) -> None:
+        """Registra una tarea (petición de webhook o trabajo largo) que hay que dejar terminar."""
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def wait_idle(self) -> None:
+        if self._drain_task is not None:
+            await asyncio.wait({self._drain_task}, timeout=self.remaining())
+        pending = self._in_flight - {asyncio.current_task()}
+        if not pending:
+            return
+        _, pending = await asyncio.wait(pending, timeout=self.remaining())
+        if pending:
+            logger.warning("%d tareas no terminaron dentro del plazo de drenaje.", len(pending))
+
+    def install_signal_handler(self) -> None:
+        """Encadena el manejador de SIGTERM de Uvicorn para empezar a drenar en cuanto llega la señal."""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+        if not callable(previous):
+            return
+        loop = asyncio.get_running_loop()
+
+        def on_sigterm(signum, frame):
+            self.begin_drain()
+            loop.call_later(self.grace_period, previous, signum, frame)
+
+        # El trabajo real se hace en el bucle: el manejador de señal solo lo programa
+        signal.signal(signal.SIGTERM, lambda signum, frame: loop.call_soon_threadsafe(on_sigterm, signum, frame))
+
+
+shutdown_coordinator = ShutdownCoordinator(SHUTDOWN_DRAIN_TIMEOUT, SHUTDOWN_GRACE_PERIOD)
+
+
+# --- DIFUSIONES REANUDABLES ---
+
+BROADCAST_STATUS_RUNNING = 'running'
+BROADCAST_STATUS_INTERRUPTED = 'interrupted'
+BROADCAST_STATUS_DONE = 'done'
+BROADCAST_PAGE_SIZE = 500
+# Envíos entre checkpoints: como mucho se repiten estos mensajes tras una caída
+BROADCAST_CHECKPOINT_EVERY = 50
+# Una difusión "running" sin checkpoint en este tiempo se da por huérfana
+BROADCAST_STALE_AFTER = timedelta(minutes=5)
+
+
+def _broadcast_page(cursor: Optional[str]) -> List[str]:
+    query = (
+        db.collection('users').select([FieldPath.document_id()])
+        .order_by(FieldPath.document_id()).limit(BROADCAST_PAGE_SIZE)
+    )
+    if cursor:
+        query = query.start_after({FieldPath.document_id(): cursor})
+    return [doc.id for doc in query.stream()]
+
+
+async def create_broadcast(text: str, created_by: int, request_id: str) -> Optional[str]:
+    """
+    Crea el trabajo con un ID derivado del mensaje del admin, de modo que una
+    reentrega de la misma actualización no crea otra difusión. Devuelve None si ya existía.
+    """
+    job_ref = db.collection('broadcast_jobs').document(request_id)
+    now = utc_now()
+    try:
+        await firestore_call('broadcast_jobs.create', job_ref.create, {
+            'text': text,
+            'created_by': created_by,
+            'status': BROADCAST_STATUS_RUNNING,
+            'cursor': None,
+            'processed': 0,
+            'created_at': now,
+            'updated_at': now,
+        })
+    except AlreadyExists:
+        logger.info("La difusión %s ya existe; se ignora la reentrega.", request_id)
+        return None
+    return job_ref.id
+
+
+async def run_broadcast(bot, job_id: str) -> bool:
+    """Envía la difusión desde su último checkpoint. Devuelve False si se interrumpe por un apagado."""
+    shutdown_coordinator.track(asyncio.current_task())
+    job_ref = db.collection('broadcast_jobs').document(job_id)
+    job = (await firestore_call('broadcast_jobs.get', job_ref.get)).to_dict()
+    cursor, processed = job.get('cursor'), job.get('processed', 0)
+
+    async def checkpoint(status: str) -> None:
+        await firestore_call('broadcast_jobs.checkpoint', job_ref.update, {
+            'cursor': cursor, 'processed': processed, 'status': status, 'updated_at': utc_now(),
+        })
+
+    while True:
+        user_ids = await firestore_call('users.page', _broadcast_page, cursor)
+        for user_id in user_ids:
+            if shutdown_coordinator.stopping:
+                await checkpoint(BROADCAST_STATUS_INTERRUPTED)
+                logger.info("Difusión %s interrumpida tras %d envíos; se reanudará.", job_id, processed)
+                return False
+            try:
+                await bot.send_message(chat_id=user_id, text=job['text'])
+            except Exception as e:
+                logger.error("Error al enviar mensaje a %s: %s", user_id, e,
+                             extra={'category': 'broadcast.recipient_error'})
+            cursor, processed = user_id, processed + 1
+            if processed % BROADCAST_CHECKPOINT_EVERY == 0:
+                await checkpoint(BROADCAST_STATUS_RUNNING)
+        if len(user_ids) < BROADCAST_PAGE_SIZE:
+            break
+    await checkpoint(BROADCAST_STATUS_DONE)
+    logger.info("Difusión %s completada (%d destinatarios).", job_id, processed)
+    return True
+
+
+async def _run_broadcast_and_report(bot, job_id: str, admin_id: int, locale: Optional[str]) -> None:
+    try:
+        done = await run_broadcast(bot, job_id)
+    except Exception as e:
+        # El trabajo queda "running" sin checkpoints: la tarea de líder lo retomará
+        logger.error("Error en la difusión %s; se reanudará: %s", job_id, e)
+        return
+    try:
+        await bot.send_message(
+            chat_id=admin_id, text=messages.render(locale, 'broadcast_sent' if done else 'broadcast_interrupted')
+        )
+    except Exception as e:
+        logger.error("No se pudo avisar a %s del fin de la difusión %s: %s", admin_id, job_id, e)
+
+
+def start_broadcast(bot, job_id: str, admin_id: int, locale: Optional[str]) -> None:
+    """Lanza la difusión en segundo plano para que la petición del webhook responda enseguida."""
+    task = asyncio.get_running_loop().create_task(_run_broadcast_and_report(bot, job_id, admin_id, locale))
+    shutdown_coordinator.track(task)
+
+
+def _pending_broadcasts() -> List[str]:
+    query = db.collection('broadcast_jobs').where(
+        filter=firestore.FieldFilter('status', 'in', [BROADCAST_STATUS_RUNNING, BROADCAST_STATUS_INTERRUPTED])
+    )
+    stale_before = utc_now() - BROADCAST_STALE_AFTER
+    job_ids = []
+    for doc in query.stream():
+        job = doc.to_dict()
+        updated_at = job.get('updated_at')
+        if job['status'] == BROADCAST_STATUS_INTERRUPTED or updated_at is None or updated_at < stale_before:
+            job_ids.append(doc.id)
+    return job_ids
+
+
+async def resume_broadcasts(application) -> None:
+    """Tarea de líder: retoma las difusiones interrumpidas por un despliegue o una caída."""
+    for job_id in await firestore_call('broadcast_jobs.pending', _pending_broadcasts):
+        if shutdown_coordinator.stopping:
+            return
+        logger.info("Reanudando la difusión %s.", job_id)
+        await firestore_call('broadcast_jobs.claim', db.collection('broadcast_jobs').document(job_id).update,
+                             {'status': BROADCAST_STATUS_RUNNING, 'updated_at': utc_now()})
+        await run_broadcast(application.bot, job_id)
+
+
+leader_election.register('resume_broadcasts', resume_broadcasts, interval=60)
+
+
+# --- TEXTOS Y TECLADOS ---
+
+DEFAULT_LOCALE = 'es'
+WEBAPP_URL = os.environ.get("WEBAPP_URL", "https://ejemplo.com")
+
+# Textos por idioma. Las claves que faltan en un idioma se toman de DEFAULT_LOCALE.
+MESSAGES = {
+    'es': {
+        'welcome_back': "¡Hola de nuevo, {name}! ¿En qué puedo ayudarte hoy?",
+        'welcome_new': "¡Hola! Bienvenido al bot de gestión de informes. Para usar todas las funciones, por favor, regístrate.",
+        'register_first': "Por favor, regístrate primero usando /start.",
+        'register_to_access': "Por favor, regístrate para acceder a las funciones.",
+        'not_admin': "No tienes permisos de administrador.",
+        'admin_menu': "Menú de administrador:",
+        'main_menu': "Elige una opción del menú principal:",
+        'report_menu': "Elige una opción para tu reporte:",
+        'ask_location': "Por favor, comparte tu ubicación para que pueda ayudarte a encontrar servicios cercanos.",
+        'help': (
+            "Aquí tienes una lista de comandos y funciones que puedo realizar:\n\n"
+            "/start - Iniciar el bot y ver el menú principal.\n"
+            "/register - Iniciar el proceso de registro.\n"
+            "/report - Iniciar el proceso de reporte de una incidencia.\n"
+            "/location - Compartir tu ubicación.\n"
+            "/create_event - Crear un evento.\n"
+            "/poll - Crear una encuesta.\n"
+            "/feedback - Enviar feedback.\n"
+            "/bug - Reportar un error.\n"
+            "/contact - Contactar con el soporte.\n"
+            "/subscribe - Suscribirse a notificaciones.\n"
+            "/unsubscribe - Darse de baja de notificaciones.\n"
+            "/check_status - Consultar el estado de un reporte.\n"
+            "/set_status - Cambiar el estado de reportes (solo para administradores).\n"
+            "/admin - Acceder al panel de administrador (solo para administradores).\n"
+            "/help - Mostrar esta ayuda."
+        ),
+        'feedback_ask': "Por favor, escribe tu feedback o sugerencia.",
+        'feedback_confirm': "Tu feedback es: \n\n'{feedback}'\n\n¿Quieres enviarlo?",
+        'feedback_sent': "¡Gracias por tu feedback! Ha sido enviado con éxito.",
+        'feedback_cancelled': "Envío de feedback cancelado.",
+        'bug_ask_description': "Por favor, describe el error que has encontrado.",
+        'bug_ask_reproduce': "¿Cómo podemos reproducir este error?",
+        'bug_ask_contact': "¿Podrías proporcionar un correo electrónico para que podamos contactarte si es necesario?",
+        'bug_confirm': "¿Quieres enviar este reporte de error?\n\nDescripción: {description}\nReproducción: {reproduce}\nContacto: {contact}",
+        'bug_sent': "¡Gracias por tu reporte de error! Ha sido enviado con éxito.",
+        'bug_cancelled': "Reporte de error cancelado.",
+        'contact_ask_name': "Por favor, introduce tu nombre completo.",
+        'contact_ask_email': "Ahora, tu correo electrónico.",
+        'contact_ask_message': "Por último, escribe el mensaje que quieres enviar.",
+        'contact_confirm': "¿Quieres enviar este mensaje de contacto?\n\nNombre: {name}\nEmail: {email}\nMensaje: {message}",
+        'contact_sent': "¡Gracias por contactarnos! Tu mensaje ha sido enviado con éxito.",
+        'contact_cancelled': "Envío de contacto cancelado.",
+        'already_subscribed': "Ya estás suscrito a las notificaciones.",
+        'subscribe_ask': "¿Quieres suscribirte a las notificaciones?",
+        'subscribed': "¡Te has suscrito a las notificaciones con éxito!",
+        'subscribe_cancelled': "Suscripción cancelada.",
+        'not_subscribed': "No estás suscrito a las notificaciones.",
+        'unsubscribe_ask': "¿Quieres darte de baja de las notificaciones?",
+        'unsubscribed': "Te has dado de baja de las notificaciones con éxito.",
+        'unsubscribe_cancelled': "Desuscripción cancelada.",
+        'check_status_ask': "Por favor, introduce el ID del reporte que quieres consultar.",
+        'check_status_result': "El estado de tu reporte con ID '{report_id}' es: {status}",
+        'check_status_not_found': "No se encontró ningún reporte con ese ID o no tienes permisos para consultarlo.",
+        'webapp_open': "Haz clic en el botón para abrir la Web App.",
+        'register_ask_name': "Genial, ¡vamos a registrarte! ¿Cuál es tu nombre?",
+        'register_ask_email': "¡Hola, {name}! Por favor, dime tu correo electrónico.",
+        'register_done': "¡Gracias! Tus datos han sido guardados.",
+        'report_ask': "Por favor, describe brevemente el problema que quieres reportar.",
+        'report_received': (
+            "Gracias por tu reporte. Lo revisaremos pronto.\n\nID del reporte: {report_id}\n"
+            "Puedes consultar su estado con /check_status."
+        ),
+        'cancelled': "Operación cancelada.",
+        'broadcast_ask': "Por favor, escribe el mensaje que quieres enviar a todos los usuarios.",
+        'broadcast_started': "Difusión en marcha. Te avisaré cuando termine.",
+        'broadcast_sent': "Mensaje enviado a todos los usuarios.",
+        'broadcast_interrupted': "Envío interrumpido por un reinicio; se reanudará automáticamente.",
+        'location_received': "Tu ubicación es: Latitud {latitude}, Longitud {longitude}. Estoy buscando servicios cercanos...",
+        'event_ask_name': "Por favor, introduce el nombre del evento:",
+        'event_ask_date': "¿Cuál es la fecha del evento? (Ej: 2025-10-27)",
+        'event_invalid_date': "Fecha no válida. Usa el formato AAAA-MM-DD (Ej: 2025-10-27).",
+        'event_ask_time': "¿A qué hora será el evento? (Ej: 18:30)",
+        'event_invalid_time': "Hora no válida. Usa el formato HH:MM (Ej: 18:30).",
+        'event_ask_location': "¿Dónde se celebrará el evento?",
+        'event_ask_description': "Por último, introduce una descripción del evento:",
+        'event_created': "Evento '{name}' creado con éxito. ¡Gracias!",
+        'poll_ask_question': "¿Cuál es la pregunta de la encuesta?",
+        'poll_ask_options': "Ahora, introduce las opciones de la encuesta separadas por comas.",
+        'poll_created': "Encuesta creada con éxito.",
+        'set_status_usage': "Uso: /set_status <pendiente|revision|resuelto> <id> [<id> ...]",
+        'set_status_result': "{count} reportes actualizados a '{status}'.",
+        'set_status_skipped': "Omitidos (no existen o transición no permitida): {report_ids}",
+        'status_changed_one': "El estado de tu reporte con ID '{report_id}' ha cambiado a: {status}",
+        'status_changed_many': "Se ha actualizado el estado de {count} de tus reportes:\n{lines}",
+        'status_pending': "Pendiente",
+        'status_in_review': "En revisión",
+        'status_resolved': "Resuelto",
+        'button_register': "Registrarme",
+        'button_broadcast': "Enviar mensaje a todos",
+        'button_view_reports': "Ver reportes",
+        'button_report_menu': "Reportar Incidencia",
+        'button_check_status': "Consultar Estado",
+        'button_admin_menu': "Panel de Administrador",
+        'button_describe_report': "Describir Incidencia",
+        'button_attach_photo': "Adjuntar Foto",
+        'button_share_location': "Compartir Ubicación",
+        'button_back_to_main': "Volver al Menú Principal",
+        'button_share_my_location': "Compartir mi ubicación",
+        'button_open_webapp': "Abrir Web App",
+        'button_confirm': "Confirmar",
+        'button_cancel': "Cancelar",
+        'button_yes': "Sí",
+        'button_no': "No",
+    },
+    'en': {
+        'welcome_back': "Welcome back, {name}! How can I help you today?",
+        'welcome_new': "Hi! Welcome to the report management bot. To use every feature, please register.",
+        'register_first': "Please register first using /start.",
+        'register_to_access': "Please register to access the features.",
+        'not_admin': "You don't have administrator permissions.",
+        'admin_menu': "Administrator menu:",
+        'main_menu': "Choose an option from the main menu:",
+        'report_menu': "Choose an option for your report:",
+        'ask_location': "Please share your location so I can help you find nearby services.",
+        'help': (
+            "Here is a list of the commands and features I offer:\n\n"
+            "/start - Start the bot and show the main menu.\n"
+            "/register - Start the registration process.\n"
+            "/report - Report an incident.\n"
+            "/location - Share your location.\n"
+            "/create_event - Create an event.\n"
+            "/poll - Create a poll.\n"
+            "/feedback - Send feedback.\n"
+            "/bug - Report a bug.\n"
+            "/contact - Contact support.\n"
+            "/subscribe - Subscribe to notifications.\n"
+            "/unsubscribe - Unsubscribe from notifications.\n"
+            "/check_status - Check the status of a report.\n"
+            "/set_status - Change the status of reports (administrators only).\n"
+            "/admin - Open the administrator panel (administrators only).\n"
+            "/help - Show this help."
+        ),
+        'feedback_ask': "Please write your feedback or suggestion.",
+        'feedback_confirm': "Your feedback is: \n\n'{feedback}'\n\nDo you want to send it?",
+        'feedback_sent': "Thanks for your feedback! It has been sent successfully.",
+        'feedback_cancelled': "Feedback cancelled.",
+        'bug_ask_description': "Please describe the bug you found.",
+        'bug_ask_reproduce': "How can we reproduce this bug?",
+        'bug_ask_contact': "Could you provide an email address so we can contact you if needed?",
+        'bug_confirm': "Do you want to send this bug report?\n\nDescription: {description}\nSteps: {reproduce}\nContact: {contact}",
+        'bug_sent': "Thanks for your bug report! It has been sent successfully.",
+        'bug_cancelled': "Bug report cancelled.",
+        'contact_ask_name': "Please enter your full name.",
+        'contact_ask_email': "Now, your email address.",
+        'contact_ask_message': "Finally, write the message you want to send.",
+        'contact_confirm': "Do you want to send this contact message?\n\nName: {name}\nEmail: {email}\nMessage: {message}",
+        'contact_sent': "Thanks for contacting us! Your message has been sent successfully.",
+        'contact_cancelled': "Contact message cancelled.",
+        'already_subscribed': "You are already subscribed to notifications.",
+        'subscribe_ask': "Do you want to subscribe to notifications?",
+        'subscribed': "You have subscribed to notifications!",
+        'subscribe_cancelled': "Subscription cancelled.",
+        'not_subscribed': "You are not subscribed to notifications.",
+        'unsubscribe_ask': "Do you want to unsubscribe from notifications?",
+        'unsubscribed': "You have unsubscribed from notifications.",
+        'unsubscribe_cancelled': "Unsubscription cancelled.",
+        'check_status_ask': "Please enter the ID of the report you want to check.",
+        'check_status_result': "The status of your report with ID '{report_id}' is: {status}",
+        'check_status_not_found': "No report was found with that ID, or you are not allowed to see it.",
+        'webapp_open': "Tap the button to open the Web App.",
+        'register_ask_name': "Great, let's get you registered! What's your name?",
+        'register_ask_email': "Hi, {name}! Please tell me your email address.",
+        'register_done': "Thanks! Your details have been saved.",
+        'report_ask': "Please briefly describe the problem you want to report.",
+        'report_received': (
+            "Thanks for your report. We will review it soon.\n\nReport ID: {report_id}\n"
+            "You can check its status with /check_status."
+        ),
+        'cancelled': "Operation cancelled.",
+        'broadcast_ask': "Please write the message you want to send to every user.",
+        'broadcast_started': "Broadcast started. I'll let you know when it finishes.",
+        'broadcast_sent': "Message sent to every user.",
+        'broadcast_interrupted': "Sending was interrupted by a restart; it will resume automatically.",
+        'location_received': "Your location is: latitude {latitude}, longitude {longitude}. Looking for nearby services...",
+        'event_ask_name': "Please enter the name of the event:",
+        'event_ask_date': "What is the date of the event? (e.g. 2025-10-27)",
+        'event_invalid_date': "Invalid date. Use the YYYY-MM-DD format (e.g. 2025-10-27).",
+        'event_ask_time': "What time is the event? (e.g. 18:30)",
+        'event_invalid_time': "Invalid time. Use the HH:MM format (e.g. 18:30).",
+        'event_ask_location': "Where will the event take place?",
+        'event_ask_description': "Finally, enter a description of the event:",
+        'event_created': "Event '{name}' created successfully. Thanks!",
+        'poll_ask_question': "What is the poll question?",
+        'poll_ask_options': "Now enter the poll options separated by commas.",
+        'poll_created': "Poll created successfully.",
+        'set_status_usage': "Usage: /set_status <pendiente|revision|resuelto> <id> [<id> ...]",
+        'set_status_result': "{count} reports updated to '{status}'.",
+        'set_status_skipped': "Skipped (missing or transition not allowed): {report_ids}",
+        'status_changed_one': "The status of your report with ID '{report_id}' has changed to: {status}",
+        'status_changed_many': "The status of {count} of your reports has been updated:\n{lines}",
+        'status_pending': "Pending",
+        'status_in_review': "In review",
+        'status_resolved': "Resolved",
+        'button_register': "Register",
+        'button_broadcast': "Message everyone",
+        'button_view_reports': "View reports",
+        'button_report_menu': "Report an incident",
+        'button_check_status': "Check status",
+        'button_admin_menu': "Administrator panel",
+        'button_describe_report': "Describe the incident",
+        'button_attach_photo': "Attach a photo",
+        'button_share_location': "Share location",
+        'button_back_to_main': "Back to the main menu",
+        'button_share_my_location': "Share my location",
+        'button_open_webapp': "Open Web App",
+        'button_confirm': "Confirm",
+        'button_cancel': "Cancel",
+        'button_yes': "Yes",
+        'button_no': "No",
+    },
+}
+
+
+def _inline_keyboard(*rows):
+    """Constructor de teclados en línea: cada fila es una lista de (clave de texto, callback_data)."""
+    return lambda text: InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text(label), callback_data=data) for label, data in row] for row in rows]
+    )
+
+
+def _confirm_keyboard(confirm_data: str, cancel_data: str, yes_no: bool = False):
+    confirm, cancel = ('button_yes', 'button_no') if yes_no else ('button_confirm', 'button_cancel')
+    return _inline_keyboard([(confirm, confirm_data)], [(cancel, cancel_data)])
+
+
+_MAIN_MENU_ROWS = ([('button_report_menu', 'report_menu')], [('button_check_status', 'check_status')])
+
+# Teclados estáticos; se construyen una sola vez por idioma
+KEYBOARDS = {
+    'register': _inline_keyboard([('button_register', 'register')]),
+    'admin_menu': _inline_keyboard([('button_broadcast', 'broadcast')], [('button_view_reports', 'view_reports')]),
+    'main_menu': _inline_keyboard(*_MAIN_MENU_ROWS),
+    'main_menu_admin': _inline_keyboard(*_MAIN_MENU_ROWS, [('button_admin_menu', 'admin_menu')]),
+    'report_menu': _inline_keyboard(
+        [('button_describe_report', 'start_report')],
+        [('button_attach_photo', 'attach_photo')],
+        [('button_share_location', 'share_location')],
+        [('button_back_to_main', 'main_menu')],
+    ),
+    'confirm_feedback': _confirm_keyboard('confirm_feedback', 'cancel_feedback'),
+    'confirm_bug': _confirm_keyboard('confirm_bug', 'cancel_bug'),
+    'confirm_contact': _confirm_keyboard('confirm_contact', 'cancel_contact'),
+    'confirm_subscribe': _confirm_keyboard('confirm_subscribe', 'cancel_subscribe', yes_no=True),
+    'confirm_unsubscribe': _confirm_keyboard('confirm_unsubscribe', 'cancel_unsubscribe', yes_no=True),
+    'share_location': lambda text: ReplyKeyboardMarkup(
+        [[KeyboardButton(text('button_share_my_location'), request_location=True)]],
+        resize_keyboard=True, one_time_keyboard=True,
+    ),
+    'webapp': lambda text: ReplyKeyboardMarkup(
+        [[KeyboardButton(text('button_open_webapp'), web_app=WebAppInfo(url=WEBAPP_URL))]],
+        resize_keyboard=True, one_time_keyboard=True,
+    ),
+}
+
+
+class MessageRegistry:
+    """
+    Textos y teclados por idioma, resueltos al arrancar: los textos estáticos y
+    los teclados (objetos inmutables de PTB) se comparten entre peticiones y
+    las plantillas se guardan como su método `format` ya enlazado.
+    """
+
+    def __init__(self, messages: Dict[str, Dict[str, str]], keyboards: Dict, default_locale: str):
+        self.default_locale = default_locale
+        self._texts: Dict[str, Dict[str, str]] = {}
+        self._templates: Dict[str, Dict] = {}
+        self._keyboards: Dict[str, Dict] = {}
+        for locale in messages:
+            texts = {**messages[default_locale], **messages[locale]}
+            self._texts[locale] = texts
+            self._templates[locale] = {key: text.format for key, text in texts.items() if '{' in text}
+            self._keyboards[locale] = {name: build(texts.__getitem__) for name, build in keyboards.items()}
+
+    def locale(self, update: Update) -> str:
+        user = update.effective_user
+        code = (user.language_code or '')[:2] if user else ''
+        return code if code in self._texts else self.default_locale
+
+    def text(self, update: Update, key: str, **params) -> str:
+        return self.render(self.locale(update), key, **params)
+
+    def render(self, locale: Optional[str], key: str, **params) -> str:
+        """Como `text`, para los mensajes que se envían fuera de una actualización (None = idioma por defecto)."""
+        locale = locale if locale in self._texts else self.default_locale
+        if params:
+            return self._templates[locale][key](**params)
+        return self._texts[locale][key]
+
+    def status(self, locale: Optional[str], status: str) -> str:
+        """Nombre traducido de un estado de reporte (los valores guardados están en español)."""
+        key = REPORT_STATUS_KEYS.get(status)
+        return self.render(locale, key) if key else status
+
+    def keyboard(self, update: Update, name: str):
+        return self._keyboards[self.locale(update)][name]
+
+
+messages = MessageRegistry(MESSAGES, KEYBOARDS, DEFAULT_LOCALE)
 
 # --- HANDLERS DEL BOT Y LÓGICA DE CONVERSACIÓN ---
 
@@ -142,103 +2377,95 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
     if user_data:
         await update.message.reply_text(
-            f"¡Hola de nuevo, {user_data.get('name')}! ¿En qué puedo ayudarte hoy?"
+            messages.text(update, 'welcome_back', name=user_data.get('name'))
         )
     else:
-        keyboard = [
-            [InlineKeyboardButton("Registrarme", callback_data="register")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
-            "¡Hola! Bienvenido al bot de gestión de informes. Para usar todas las funciones, por favor, regístrate.",
-            reply_markup=reply_markup
+            messages.text(update, 'welcome_new'),
+            reply_markup=messages.keyboard(update, 'register')
         )
     return MAIN_MENU
 
 async def register_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Genial, ¡vamos a registrarte! ¿Cuál es tu nombre?")
+    await query.edit_message_text(messages.text(update, 'register_ask_name'))
     return REGISTER_NAME
 
 async def register_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     name = update.message.text
     context.user_data['name'] = name
-    await update.message.reply_text(f"¡Hola, {name}! Por favor, dime tu correo electrónico.")
+    await update.message.reply_text(messages.text(update, 'register_ask_email', name=name))
     return REGISTER_EMAIL
 
 async def register_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     email = update.message.text
     context.user_data['email'] = email
     
-    await asyncio.to_thread(db.collection('users').document(str(update.effective_user.id)).set, context.user_data)
+    await firestore_call('users.set', db.collection('users').document(str(update.effective_user.id)).set, dict(context.user_data))
+    registration_cache.mark_registered(update.effective_user.id)
+    analytics.increment('users.registered')
 
-    await update.message.reply_text("¡Gracias! Tus datos han sido guardados.")
+    await update.message.reply_text(messages.text(update, 'register_done'))
     return ConversationHandler.END
 
 async def report_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Inicia la conversación para reportar un problema."""
-    await update.message.reply_text("Por favor, describe brevemente el problema que quieres reportar.")
+    await update.message.reply_text(messages.text(update, 'report_ask'))
     return REPORT_DETAILS
 
 async def report_details(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Guarda los detalles del reporte y finaliza."""
     report = update.message.text
     
-    report_data = {'report_text': report}
-    await add_report_to_db(report_data, update.effective_user.id)
+    # El idioma se guarda para redactar los avisos de cambio de estado
+    report_data = {'report_text': report, 'locale': messages.locale(update)}
+    report_id = await add_report_to_db(report_data, update.effective_user.id)
     
-    await update.message.reply_text("Gracias por tu reporte. Lo revisaremos pronto.")
+    await update.message.reply_text(messages.text(update, 'report_received', report_id=report_id))
     return ConversationHandler.END
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancela cualquier conversación en curso."""
-    await update.message.reply_text("Operación cancelada.")
+    await update.message.reply_text(messages.text(update, 'cancelled'))
     return ConversationHandler.END
 
 async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await is_admin(update.effective_user.id):
-        await update.message.reply_text("No tienes permisos de administrador.")
+        await update.message.reply_text(messages.text(update, 'not_admin'))
         return ConversationHandler.END
 
-    keyboard = [
-        [InlineKeyboardButton("Enviar mensaje a todos", callback_data="broadcast")],
-        [InlineKeyboardButton("Ver reportes", callback_data="view_reports")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Menú de administrador:", reply_markup=reply_markup)
+    await update.message.reply_text(
+        messages.text(update, 'admin_menu'), reply_markup=messages.keyboard(update, 'admin_menu')
+    )
     return ADMIN_MENU
 
 async def admin_broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Por favor, escribe el mensaje que quieres enviar a todos los usuarios.")
+    await query.edit_message_text(messages.text(update, 'broadcast_ask'))
     return ADMIN_BROADCAST
 
-async def admin_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    message_to_send = update.message.text
-    users_ref = db.collection('users')
-    users_docs = await asyncio.to_thread(users_ref.stream)
-    
-    for user_doc in users_docs:
-        try:
-            await context.bot.send_message(chat_id=user_doc.id, text=message_to_send)
-        except Exception as e:
-            logger.error(f"Error al enviar mensaje a {user_doc.id}: {e}")
-
-    await update.message.reply_text("Mensaje enviado a todos los usuarios.")
+async def launch_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Crea la difusión con el texto del admin y la envía en segundo plano; el aviso final llega aparte."""
+    request_id = f"{update.effective_chat.id}-{update.message.message_id}"
+    job_id = await create_broadcast(update.message.text, update.effective_user.id, request_id)
+    if job_id is not None:
+        start_broadcast(context.bot, job_id, update.effective_user.id, messages.locale(update))
+    await update.message.reply_text(messages.text(update, 'broadcast_started'))
     return ConversationHandler.END
 
+async def admin_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await launch_broadcast(update, context)
+
 async def ask_location_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await check_user_registered(update.effective_user.id):
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return ConversationHandler.END
 
-    keyboard = [[KeyboardButton("Compartir mi ubicación", request_location=True)]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
     await update.message.reply_text(
-        "Por favor, comparte tu ubicación para que pueda ayudarte a encontrar servicios cercanos.",
-        reply_markup=reply_markup
+        messages.text(update, 'ask_location'),
+        reply_markup=messages.keyboard(update, 'share_location')
     )
     return GET_LOCATION
 
@@ -248,37 +2475,45 @@ async def get_location_and_search(update: Update, context: ContextTypes.DEFAULT_
     longitud = location.longitude
 
     await update.message.reply_text(
-        f"Tu ubicación es: Latitud {latitud}, Longitud {longitud}. Estoy buscando servicios cercanos...",
+        messages.text(update, 'location_received', latitude=latitud, longitude=longitud),
         reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
 async def event_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("Por favor, introduce el nombre del evento:")
+    await update.message.reply_text(messages.text(update, 'event_ask_name'))
     return EVENT_NAME
 
 async def event_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     event_name_text = update.message.text
     context.user_data['event_name'] = event_name_text
-    await update.message.reply_text("¿Cuál es la fecha del evento? (Ej: 2025-10-27)")
+    await update.message.reply_text(messages.text(update, 'event_ask_date'))
     return EVENT_DATE
 
 async def event_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    event_date_text = update.message.text
-    context.user_data['event_date'] = event_date_text
-    await update.message.reply_text("¿A qué hora será el evento? (Ej: 18:30)")
+    try:
+        event_day = parse_date(update.message.text)
+    except ValueError:
+        await update.message.reply_text(messages.text(update, 'event_invalid_date'))
+        return EVENT_DATE
+    context.user_data['event_date'] = event_day.isoformat()
+    await update.message.reply_text(messages.text(update, 'event_ask_time'))
     return EVENT_TIME
 
 async def event_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    event_time_text = update.message.text
-    context.user_data['event_time'] = event_time_text
-    await update.message.reply_text("¿Dónde se celebrará el evento?")
+    try:
+        event_hour = parse_time(update.message.text)
+    except ValueError:
+        await update.message.reply_text(messages.text(update, 'event_invalid_time'))
+        return EVENT_TIME
+    context.user_data['event_time'] = event_hour.strftime('%H:%M')
+    await update.message.reply_text(messages.text(update, 'event_ask_location'))
     return EVENT_LOCATION
 
 async def event_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     event_location_text = update.message.text
     context.user_data['event_location'] = event_location_text
-    await update.message.reply_text("Por último, introduce una descripción del evento:")
+    await update.message.reply_text(messages.text(update, 'event_ask_description'))
     return EVENT_DESCRIPTION
 
 async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -287,21 +2522,22 @@ async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     
     event_data = context.user_data
     event_data['created_by'] = update.effective_user.id
-    await asyncio.to_thread(db.collection('events').add, event_data)
+    event_data['created_at'] = utc_now()
+    # Instante UTC del evento, para poder ordenar y filtrar por rango
+    event_data['event_at'] = local_to_utc(parse_date(event_data['event_date']), parse_time(event_data['event_time']))
+    await firestore_call('events.add', db.collection('events').add, dict(event_data))
     
-    await update.message.reply_text(
-        f"Evento '{event_data['event_name']}' creado con éxito. ¡Gracias!"
-    )
+    await update.message.reply_text(messages.text(update, 'event_created', name=event_data['event_name']))
     return ConversationHandler.END
 
 async def start_poll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("¿Cuál es la pregunta de la encuesta?")
+    await update.message.reply_text(messages.text(update, 'poll_ask_question'))
     return POLL_QUESTION
 
 async def poll_options_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     question = update.message.text
     context.user_data['poll_question'] = question
-    await update.message.reply_text("Ahora, introduce las opciones de la encuesta separadas por comas.")
+    await update.message.reply_text(messages.text(update, 'poll_ask_options'))
     return POLL_OPTIONS_INPUT
 
 async def create_poll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -314,188 +2550,41 @@ async def create_poll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         options=options,
         is_anonymous=False
     )
-    await update.message.reply_text("Encuesta creada con éxito.")
+    await update.message.reply_text(messages.text(update, 'poll_created'))
     return ConversationHandler.END
 
 async def send_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("Por favor, escribe el mensaje que quieres enviar a todos los usuarios:")
+    await update.message.reply_text(messages.text(update, 'broadcast_ask'))
     return BROADCAST_MESSAGE
 
 async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    message_to_send = update.message.text
-    users_ref = db.collection('users')
-    users_docs = await asyncio.to_thread(users_ref.stream)
-    
-    for user_doc in users_docs:
-        try:
-            await context.bot.send_message(chat_id=user_doc.id, text=message_to_send)
-        except Exception as e:
-            logger.error(f"Error al enviar mensaje a {user_doc.id}: {e}")
-            
-    await update.message.reply_text("Mensaje enviado a todos los usuarios.")
-    return ConversationHandler.END
+    return await launch_broadcast(update, context)
 
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     is_registered = await check_user_registered(user_id)
     
     if not is_registered:
-        keyboard = [[InlineKeyboardButton("Registrarme", callback_data="register")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Por favor, regístrate para acceder a las funciones.", reply_markup=reply_markup)
+        await update.message.reply_text(
+            messages.text(update, 'register_to_access'), reply_markup=messages.keyboard(update, 'register')
+        )
         return MAIN_MENU
 
-    keyboard = [
-        [InlineKeyboardButton("Reportar Incidencia", callback_data="report_menu")],
-        [InlineKeyboardButton("Consultar Estado", callback_data="check_status")],
-    ]
-    if await is_admin(user_id):
-        keyboard.append([InlineKeyboardButton("Panel de Administrador", callback_data="admin_menu")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Elige una opción del menú principal:", reply_markup=reply_markup)
+    keyboard_name = 'main_menu_admin' if await is_admin(user_id) else 'main_menu'
+    await update.message.reply_text(
+        messages.text(update, 'main_menu'), reply_markup=messages.keyboard(update, keyboard_name)
+    )
     return MAIN_MENU
 
 async def report_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     
-    keyboard = [
-        [InlineKeyboardButton("Describir Incidencia", callback_data="start_report")],
-        [InlineKeyboardButton("Adjuntar Foto", callback_data="attach_photo")],
-        [InlineKeyboardButton("Compartir Ubicación", callback_data="share_location")],
-        [InlineKeyboardButton("Volver al Menú Principal", callback_data="main_menu")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Elige una opción para tu reporte:", reply_markup=reply_markup)
+    await query.edit_message_text(
+        messages.text(update, 'report_menu'), reply_markup=messages.keyboard(update, 'report_menu')
+    )
     return REPORT_MENU
 
-# --- CONFIGURACIÓN DE FASTAPI Y LIFESPAN ---
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """
-    Función de lifespan para FastAPI. Se ejecuta al iniciar la app.
-    Aquí inicializamos el bot y configuramos el webhook.
-    """
-    global application
-    logger.info("Iniciando aplicación FastAPI...")
-    try:
-        application = ApplicationBuilder().token(TOKEN).updater(None).build()
-
-        # Carga todos los manejadores del bot
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CallbackQueryHandler(register_callback, pattern='^register$'))
-        
-        # Handlers de conversación
-        register_handler = ConversationHandler(
-            entry_points=[CallbackQueryHandler(register_callback, pattern='^register$')],
-            states={
-                REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_name)],
-                REGISTER_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_email)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(register_handler)
-
-        report_handler = ConversationHandler(
-            entry_points=[CommandHandler('report', report_start)],
-            states={
-                REPORT_DETAILS: [MessageHandler(filters.TEXT & ~filters.COMMAND, report_details)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(report_handler)
-
-        admin_handler = ConversationHandler(
-            entry_points=[CommandHandler('admin', admin_start)],
-            states={
-                ADMIN_MENU: [CallbackQueryHandler(admin_broadcast_callback, pattern='^broadcast$')],
-                ADMIN_BROADCAST: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_message)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(admin_handler)
-
-        location_handler = ConversationHandler(
-            entry_points=[CommandHandler('location', ask_location_start)],
-            states={
-                GET_LOCATION: [MessageHandler(filters.LOCATION, get_location_and_search)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(location_handler)
-
-        event_handler = ConversationHandler(
-            entry_points=[CommandHandler('create_event', event_name)],
-            states={
-                EVENT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_date)],
-                EVENT_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_time)],
-                EVENT_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_location)],
-                EVENT_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_description)],
-                EVENT_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_event)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(event_handler)
-
-        poll_handler = ConversationHandler(
-            entry_points=[CommandHandler('poll', start_poll)],
-            states={
-                POLL_QUESTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, poll_options_input)],
-                POLL_OPTIONS_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_poll)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(poll_handler)
-
-        logger.info("Manejadores del bot cargados.")
-
-        # Establece la URL del webhook en Telegram
-        await application.bot.set_webhook(url=WEBHOOK_URL)
-        logger.info(f"Webhook configurado en la URL: {WEBHOOK_URL}")
-
-        yield
-    except Exception as e:
-        logger.error(f"Error durante la inicialización de la aplicación: {e}")
-        sys.exit(1)
-    finally:
-        logger.info("Apagando aplicación FastAPI...")
-
-app = FastAPI(lifespan=lifespan)
-
-@app.post("/")
-async def webhook_handler(request: Request):
-    global application
-    if application is None:
-        logger.error("La aplicación de Telegram no se ha inicializado.")
-        raise HTTPException(status_code=500, detail="Bot application not initialized.")
-        
-    try:
-        data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.process_update(update)
-
-        return {"status": "ok"}
-    except Exception as e:
-        logger.error(f"Error al procesar la actualización: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Servidor FastAPI iniciado.")
-    # El webhook se configura en el lifespan, no es necesario aquí
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    if application and application.running:
-        await application.stop()
-        logger.info("Aplicación del bot de Telegram detenida.")
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
-
 # Aquí empieza el resto del código que faltaba
 # --- Funciones de soporte para el bot ---
 
@@ -505,42 +2594,24 @@ def generate_random_id():
 # --- Handlers adicionales ---
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text("Aquí tienes una lista de comandos y funciones que puedo realizar:\n\n"
-                                    "/start - Iniciar el bot y ver el menú principal.\n"
-                                    "/register - Iniciar el proceso de registro.\n"
-                                    "/report - Iniciar el proceso de reporte de una incidencia.\n"
-                                    "/location - Compartir tu ubicación.\n"
-                                    "/create_event - Crear un evento.\n"
-                                    "/poll - Crear una encuesta.\n"
-                                    "/feedback - Enviar feedback.\n"
-                                    "/bug - Reportar un error.\n"
-                                    "/contact - Contactar con el soporte.\n"
-                                    "/subscribe - Suscribirse a notificaciones.\n"
-                                    "/unsubscribe - Darse de baja de notificaciones.\n"
-                                    "/check_status - Consultar el estado de un reporte.\n"
-                                    "/admin - Acceder al panel de administrador (solo para administradores).\n"
-                                    "/help - Mostrar esta ayuda.")
-    logger.info(f"Comando /help recibido de {update.effective_user.id}")
+    await update.message.reply_text(messages.text(update, 'help'))
+    logger.debug("Comando /help recibido de %s", update.effective_user.id)
 
 async def feedback_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await check_user_registered(update.effective_user.id):
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return ConversationHandler.END
 
-    await update.message.reply_text("Por favor, escribe tu feedback o sugerencia.")
+    await update.message.reply_text(messages.text(update, 'feedback_ask'))
     return FEEDBACK_TEXT
 
 async def feedback_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     feedback = update.message.text
     context.user_data['feedback_text'] = feedback
     
-    keyboard = [[InlineKeyboardButton("Confirmar", callback_data="confirm_feedback")],
-                [InlineKeyboardButton("Cancelar", callback_data="cancel_feedback")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
-        f"Tu feedback es: \n\n'{feedback}'\n\n¿Quieres enviarlo?",
-        reply_markup=reply_markup
+        messages.text(update, 'feedback_confirm', feedback=feedback),
+        reply_markup=messages.keyboard(update, 'confirm_feedback')
     )
     return FEEDBACK_CONFIRMATION
 
@@ -551,37 +2622,37 @@ async def confirm_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     feedback_data = {
         'user_id': query.from_user.id,
         'feedback': context.user_data['feedback_text'],
-        'timestamp': datetime.now(pytz.timezone('Europe/Madrid'))
+        'timestamp': utc_now()
     }
-    await asyncio.to_thread(db.collection('feedback').add, feedback_data)
+    await firestore_call('feedback.add', db.collection('feedback').add, feedback_data)
     
-    await query.edit_message_text("¡Gracias por tu feedback! Ha sido enviado con éxito.")
+    await query.edit_message_text(messages.text(update, 'feedback_sent'))
     return ConversationHandler.END
 
 async def cancel_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Envío de feedback cancelado.")
+    await query.edit_message_text(messages.text(update, 'feedback_cancelled'))
     return ConversationHandler.END
 
 async def bug_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await check_user_registered(update.effective_user.id):
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return ConversationHandler.END
 
-    await update.message.reply_text("Por favor, describe el error que has encontrado.")
+    await update.message.reply_text(messages.text(update, 'bug_ask_description'))
     return BUG_DESCRIPTION
 
 async def bug_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     description = update.message.text
     context.user_data['bug_description'] = description
-    await update.message.reply_text("¿Cómo podemos reproducir este error?")
+    await update.message.reply_text(messages.text(update, 'bug_ask_reproduce'))
     return BUG_REPRODUCE
 
 async def bug_reproduce(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     reproduce = update.message.text
     context.user_data['bug_reproduce'] = reproduce
-    await update.message.reply_text("¿Podrías proporcionar un correo electrónico para que podamos contactarte si es necesario?")
+    await update.message.reply_text(messages.text(update, 'bug_ask_contact'))
     return BUG_CONTACT
 
 async def bug_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -590,15 +2661,12 @@ async def bug_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     
     bug_data = context.user_data
     bug_data['user_id'] = update.effective_user.id
-    bug_data['timestamp'] = datetime.now(pytz.timezone('Europe/Madrid'))
-
-    keyboard = [[InlineKeyboardButton("Confirmar", callback_data="confirm_bug")],
-                [InlineKeyboardButton("Cancelar", callback_data="cancel_bug")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    bug_data['timestamp'] = utc_now()
 
     await update.message.reply_text(
-        f"¿Quieres enviar este reporte de error?\n\nDescripción: {bug_data['bug_description']}\nReproducción: {bug_data['bug_reproduce']}\nContacto: {bug_data['bug_contact']}",
-        reply_markup=reply_markup
+        messages.text(update, 'bug_confirm', description=bug_data['bug_description'],
+                      reproduce=bug_data['bug_reproduce'], contact=bug_data['bug_contact']),
+        reply_markup=messages.keyboard(update, 'confirm_bug')
     )
     return BUG_CONFIRMATION
 
@@ -608,37 +2676,37 @@ async def confirm_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     
     bug_data = context.user_data
     bug_data['user_id'] = query.from_user.id
-    bug_data['timestamp'] = datetime.now(pytz.timezone('Europe/Madrid'))
+    bug_data['timestamp'] = utc_now()
     
-    await asyncio.to_thread(db.collection('bugs').add, bug_data)
+    await firestore_call('bugs.add', db.collection('bugs').add, dict(bug_data))
     
-    await query.edit_message_text("¡Gracias por tu reporte de error! Ha sido enviado con éxito.")
+    await query.edit_message_text(messages.text(update, 'bug_sent'))
     return ConversationHandler.END
 
 async def cancel_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Reporte de error cancelado.")
+    await query.edit_message_text(messages.text(update, 'bug_cancelled'))
     return ConversationHandler.END
 
 async def contact_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await check_user_registered(update.effective_user.id):
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return ConversationHandler.END
 
-    await update.message.reply_text("Por favor, introduce tu nombre completo.")
+    await update.message.reply_text(messages.text(update, 'contact_ask_name'))
     return CONTACT_NAME
 
 async def contact_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     name = update.message.text
     context.user_data['contact_name'] = name
-    await update.message.reply_text("Ahora, tu correo electrónico.")
+    await update.message.reply_text(messages.text(update, 'contact_ask_email'))
     return CONTACT_EMAIL
 
 async def contact_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     email = update.message.text
     context.user_data['contact_email'] = email
-    await update.message.reply_text("Por último, escribe el mensaje que quieres enviar.")
+    await update.message.reply_text(messages.text(update, 'contact_ask_message'))
     return CONTACT_MESSAGE
 
 async def contact_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -647,15 +2715,12 @@ async def contact_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     contact_data = context.user_data
     contact_data['user_id'] = update.effective_user.id
-    contact_data['timestamp'] = datetime.now(pytz.timezone('Europe/Madrid'))
-
-    keyboard = [[InlineKeyboardButton("Confirmar", callback_data="confirm_contact")],
-                [InlineKeyboardButton("Cancelar", callback_data="cancel_contact")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    contact_data['timestamp'] = utc_now()
 
     await update.message.reply_text(
-        f"¿Quieres enviar este mensaje de contacto?\n\nNombre: {contact_data['contact_name']}\nEmail: {contact_data['contact_email']}\nMensaje: {contact_data['contact_message']}",
-        reply_markup=reply_markup
+        messages.text(update, 'contact_confirm', name=contact_data['contact_name'],
+                      email=contact_data['contact_email'], message=contact_data['contact_message']),
+        reply_markup=messages.keyboard(update, 'confirm_contact')
     )
     return CONTACT_CONFIRMATION
 
@@ -665,36 +2730,35 @@ async def confirm_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     contact_data = context.user_data
     contact_data['user_id'] = query.from_user.id
-    contact_data['timestamp'] = datetime.now(pytz.timezone('Europe/Madrid'))
+    contact_data['timestamp'] = utc_now()
     
-    await asyncio.to_thread(db.collection('contact_messages').add, contact_data)
+    await firestore_call('contact_messages.add', db.collection('contact_messages').add, dict(contact_data))
     
-    await query.edit_message_text("¡Gracias por contactarnos! Tu mensaje ha sido enviado con éxito.")
+    await query.edit_message_text(messages.text(update, 'contact_sent'))
     return ConversationHandler.END
 
 async def cancel_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Envío de contacto cancelado.")
+    await query.edit_message_text(messages.text(update, 'contact_cancelled'))
     return ConversationHandler.END
 
 async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     user_ref = db.collection('users').document(str(user_id))
-    user_doc = await asyncio.to_thread(user_ref.get)
+    user_doc = await firestore_call('users.get', user_ref.get)
     
     if user_doc.exists:
         if user_doc.get('subscribed', False):
-            await update.message.reply_text("Ya estás suscrito a las notificaciones.")
+            await update.message.reply_text(messages.text(update, 'already_subscribed'))
             return ConversationHandler.END
         else:
-            keyboard = [[InlineKeyboardButton("Sí", callback_data="confirm_subscribe")],
-                        [InlineKeyboardButton("No", callback_data="cancel_subscribe")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("¿Quieres suscribirte a las notificaciones?", reply_markup=reply_markup)
+            await update.message.reply_text(
+                messages.text(update, 'subscribe_ask'), reply_markup=messages.keyboard(update, 'confirm_subscribe')
+            )
             return SUBSCRIBE_CONFIRMATION
     else:
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return ConversationHandler.END
 
 async def confirm_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -702,34 +2766,34 @@ async def confirm_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     user_ref = db.collection('users').document(str(query.from_user.id))
-    await asyncio.to_thread(user_ref.update, {'subscribed': True})
+    await firestore_call('users.update', user_ref.update, {'subscribed': True})
+    analytics.increment('subscribers.joined')
     
-    await query.edit_message_text("¡Te has suscrito a las notificaciones con éxito!")
+    await query.edit_message_text(messages.text(update, 'subscribed'))
     return ConversationHandler.END
 
 async def cancel_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Suscripción cancelada.")
+    await query.edit_message_text(messages.text(update, 'subscribe_cancelled'))
     return ConversationHandler.END
 
 async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     user_ref = db.collection('users').document(str(user_id))
-    user_doc = await asyncio.to_thread(user_ref.get)
+    user_doc = await firestore_call('users.get', user_ref.get)
     
     if user_doc.exists:
         if not user_doc.get('subscribed', False):
-            await update.message.reply_text("No estás suscrito a las notificaciones.")
+            await update.message.reply_text(messages.text(update, 'not_subscribed'))
             return ConversationHandler.END
         else:
-            keyboard = [[InlineKeyboardButton("Sí", callback_data="confirm_unsubscribe")],
-                        [InlineKeyboardButton("No", callback_data="cancel_unsubscribe")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("¿Quieres darte de baja de las notificaciones?", reply_markup=reply_markup)
+            await update.message.reply_text(
+                messages.text(update, 'unsubscribe_ask'), reply_markup=messages.keyboard(update, 'confirm_unsubscribe')
+            )
             return UNSUBSCRIBE_CONFIRMATION
     else:
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return ConversationHandler.END
 
 async def confirm_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -737,207 +2801,308 @@ async def confirm_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     user_ref = db.collection('users').document(str(query.from_user.id))
-    await asyncio.to_thread(user_ref.update, {'subscribed': False})
+    await firestore_call('users.update', user_ref.update, {'subscribed': False})
+    analytics.increment('subscribers.left')
     
-    await query.edit_message_text("Te has dado de baja de las notificaciones con éxito.")
+    await query.edit_message_text(messages.text(update, 'unsubscribed'))
     return ConversationHandler.END
 
 async def cancel_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Desuscripción cancelada.")
+    await query.edit_message_text(messages.text(update, 'unsubscribe_cancelled'))
     return ConversationHandler.END
 
 async def check_status_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await check_user_registered(update.effective_user.id):
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return ConversationHandler.END
 
-    await update.message.reply_text("Por favor, introduce el ID del reporte que quieres consultar.")
+    await update.message.reply_text(messages.text(update, 'check_status_ask'))
     return CHECK_STATUS_ID
 
 async def check_status_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     report_id = update.message.text
     report_ref = db.collection('reports').document(report_id)
-    report_doc = await asyncio.to_thread(report_ref.get)
+    report_doc = await firestore_call('reports.get', report_ref.get)
     
     if report_doc.exists and report_doc.get('user_id') == update.effective_user.id:
         report_data = report_doc.to_dict()
-        status = report_data.get('status', 'Pendiente')
-        await update.message.reply_text(f"El estado de tu reporte con ID '{report_id}' es: {status}")
+        status = report_data.get('status', REPORT_STATUS_PENDING)
+        await update.message.reply_text(messages.text(update, 'check_status_result', report_id=report_id,
+                                                      status=messages.status(messages.locale(update), status)))
     else:
-        await update.message.reply_text("No se encontró ningún reporte con ese ID o no tienes permisos para consultarlo.")
+        await update.message.reply_text(messages.text(update, 'check_status_not_found'))
         
     return ConversationHandler.END
 
+async def set_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/set_status <pendiente|revision|resuelto> <id> [<id> ...] (solo administradores)."""
+    if not await is_admin(update.effective_user.id):
+        await update.message.reply_text(messages.text(update, 'not_admin'))
+        return
+
+    new_status = REPORT_STATUS_ALIASES.get(context.args[0].lower()) if context.args else None
+    report_ids = context.args[1:]
+    if not new_status or not report_ids:
+        await update.message.reply_text(messages.text(update, 'set_status_usage'))
+        return
+
+    result = await update_report_statuses(report_ids, new_status)
+    locale = messages.locale(update)
+    message = messages.render(locale, 'set_status_result', count=len(result['updated']),
+                              status=messages.status(locale, new_status))
+    if result['skipped']:
+        message += '\n' + messages.render(locale, 'set_status_skipped', report_ids=', '.join(result['skipped']))
+    await update.message.reply_text(message)
+
 async def webapp_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_user_registered(update.effective_user.id):
-        await update.message.reply_text("Por favor, regístrate primero usando /start.")
+        await update.message.reply_text(messages.text(update, 'register_first'))
         return
     
-    keyboard = [[KeyboardButton("Abrir Web App", web_app=WebAppInfo(url="https://ejemplo.com"))]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text("Haz clic en el botón para abrir la Web App.", reply_markup=reply_markup)
+    await update.message.reply_text(
+        messages.text(update, 'webapp_open'), reply_markup=messages.keyboard(update, 'webapp')
+    )
 
 # --- CONFIGURACIÓN DE FASTAPI Y HANDLERS ---
+def register_handlers(application: Application) -> None:
+    """Carga todos los manejadores del bot."""
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CallbackQueryHandler(register_callback, pattern='^register$'))
+    
+    # Handlers de conversación
+    register_handler = SharedConversationHandler(
+        name='register',
+        entry_points=[CallbackQueryHandler(register_callback, pattern='^register$')],
+        states={
+            REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_name)],
+            REGISTER_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_email)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(register_handler)
+
+    report_handler = SharedConversationHandler(
+        name='report',
+        entry_points=[CommandHandler('report', report_start)],
+        states={
+            REPORT_DETAILS: [MessageHandler(filters.TEXT & ~filters.COMMAND, report_details)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(report_handler)
+
+    admin_handler = SharedConversationHandler(
+        name='admin',
+        entry_points=[CommandHandler('admin', admin_start)],
+        states={
+            ADMIN_MENU: [CallbackQueryHandler(admin_broadcast_callback, pattern='^broadcast$')],
+            ADMIN_BROADCAST: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_message)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(admin_handler)
+
+    location_handler = SharedConversationHandler(
+        name='location',
+        entry_points=[CommandHandler('location', ask_location_start)],
+        states={
+            GET_LOCATION: [MessageHandler(filters.LOCATION, get_location_and_search)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(location_handler)
+
+    event_handler = SharedConversationHandler(
+        name='event',
+        entry_points=[CommandHandler('create_event', event_name)],
+        states={
+            EVENT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_date)],
+            EVENT_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_time)],
+            EVENT_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_location)],
+            EVENT_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_description)],
+            EVENT_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_event)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(event_handler)
+
+    poll_handler = SharedConversationHandler(
+        name='poll',
+        entry_points=[CommandHandler('poll', start_poll)],
+        states={
+            POLL_QUESTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, poll_options_input)],
+            POLL_OPTIONS_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_poll)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(poll_handler)
+
+    feedback_handler = SharedConversationHandler(
+        name='feedback',
+        entry_points=[CommandHandler('feedback', feedback_start)],
+        states={
+            FEEDBACK_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, feedback_text)],
+            FEEDBACK_CONFIRMATION: [CallbackQueryHandler(confirm_feedback, pattern='^confirm_feedback$'),
+                                     CallbackQueryHandler(cancel_feedback, pattern='^cancel_feedback$')],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(feedback_handler)
+
+    bug_handler = SharedConversationHandler(
+        name='bug',
+        entry_points=[CommandHandler('bug', bug_start)],
+        states={
+            BUG_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, bug_description)],
+            BUG_REPRODUCE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bug_reproduce)],
+            BUG_CONTACT: [MessageHandler(filters.TEXT & ~filters.COMMAND, bug_contact)],
+            BUG_CONFIRMATION: [CallbackQueryHandler(confirm_bug, pattern='^confirm_bug$'),
+                               CallbackQueryHandler(cancel_bug, pattern='^cancel_bug$')],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(bug_handler)
+
+    contact_handler = SharedConversationHandler(
+        name='contact',
+        entry_points=[CommandHandler('contact', contact_start)],
+        states={
+            CONTACT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, contact_name)],
+            CONTACT_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, contact_email)],
+            CONTACT_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, contact_message)],
+            CONTACT_CONFIRMATION: [CallbackQueryHandler(confirm_contact, pattern='^confirm_contact$'),
+                                   CallbackQueryHandler(cancel_contact, pattern='^cancel_contact$')],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(contact_handler)
+
+    subscribe_handler = SharedConversationHandler(
+        name='subscribe',
+        entry_points=[CommandHandler('subscribe', subscribe_command)],
+        states={
+            SUBSCRIBE_CONFIRMATION: [CallbackQueryHandler(confirm_subscribe, pattern='^confirm_subscribe$'),
+                                     CallbackQueryHandler(cancel_subscribe, pattern='^cancel_subscribe$')],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(subscribe_handler)
+
+    unsubscribe_handler = SharedConversationHandler(
+        name='unsubscribe',
+        entry_points=[CommandHandler('unsubscribe', unsubscribe_command)],
+        states={
+            UNSUBSCRIBE_CONFIRMATION: [CallbackQueryHandler(confirm_unsubscribe, pattern='^confirm_unsubscribe$'),
+                                       CallbackQueryHandler(cancel_unsubscribe, pattern='^cancel_unsubscribe$')],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(unsubscribe_handler)
+
+    check_status_handler = SharedConversationHandler(
+        name='check_status',
+        entry_points=[CommandHandler('check_status', check_status_start)],
+        states={
+            CHECK_STATUS_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, check_status_id)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_command)],
+    )
+    application.add_handler(check_status_handler)
+
+    webapp_handler = CommandHandler('webapp', webapp_start)
+    application.add_handler(webapp_handler)
+    application.add_handler(CommandHandler('help', help_command))
+    application.add_handler(CommandHandler('set_status', set_status_command))
+
+
+async def flush_notices_and_spans() -> None:
+    """Encola los avisos agrupados pendientes y exporta las trazas acumuladas."""
+    status_notifier.flush_all()
+    await asyncio.to_thread(tracer_provider.force_flush, 1000)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Función de lifespan para FastAPI. Se ejecuta al iniciar la app.
     Aquí inicializamos el bot y configuramos el webhook.
     """
-    global application
+    global application, update_prefilter
+    # uvicorn.run() configura sus loggers después de importar este módulo
+    route_uvicorn_logs()
     logger.info("Iniciando aplicación FastAPI...")
+    warm_task = None
     try:
-        application = ApplicationBuilder().token(TOKEN).updater(None).build()
-        
-        # Carga todos los manejadores del bot
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CallbackQueryHandler(register_callback, pattern='^register$'))
-        
-        # Handlers de conversación
-        register_handler = ConversationHandler(
-            entry_points=[CallbackQueryHandler(register_callback, pattern='^register$')],
-            states={
-                REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_name)],
-                REGISTER_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_email)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(register_handler)
-
-        report_handler = ConversationHandler(
-            entry_points=[CommandHandler('report', report_start)],
-            states={
-                REPORT_DETAILS: [MessageHandler(filters.TEXT & ~filters.COMMAND, report_details)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
+        application = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .updater(None)
+            .context_types(ContextTypes(context=SharedCallbackContext))
+            .request(TracedHTTPXRequest())
+            .build()
         )
-        application.add_handler(report_handler)
+        register_handlers(application)
 
-        admin_handler = ConversationHandler(
-            entry_points=[CommandHandler('admin', admin_start)],
-            states={
-                ADMIN_MENU: [CallbackQueryHandler(admin_broadcast_callback, pattern='^broadcast$')],
-                ADMIN_BROADCAST: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_message)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(admin_handler)
-
-        location_handler = ConversationHandler(
-            entry_points=[CommandHandler('location', ask_location_start)],
-            states={
-                GET_LOCATION: [MessageHandler(filters.LOCATION, get_location_and_search)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(location_handler)
-
-        event_handler = ConversationHandler(
-            entry_points=[CommandHandler('create_event', event_name)],
-            states={
-                EVENT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_date)],
-                EVENT_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_time)],
-                EVENT_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_location)],
-                EVENT_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_description)],
-                EVENT_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_event)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(event_handler)
-
-        poll_handler = ConversationHandler(
-            entry_points=[CommandHandler('poll', start_poll)],
-            states={
-                POLL_QUESTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, poll_options_input)],
-                POLL_OPTIONS_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_poll)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(poll_handler)
-
-        feedback_handler = ConversationHandler(
-            entry_points=[CommandHandler('feedback', feedback_start)],
-            states={
-                FEEDBACK_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, feedback_text)],
-                FEEDBACK_CONFIRMATION: [CallbackQueryHandler(confirm_feedback, pattern='^confirm_feedback$'),
-                                         CallbackQueryHandler(cancel_feedback, pattern='^cancel_feedback$')],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(feedback_handler)
-
-        bug_handler = ConversationHandler(
-            entry_points=[CommandHandler('bug', bug_start)],
-            states={
-                BUG_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, bug_description)],
-                BUG_REPRODUCE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bug_reproduce)],
-                BUG_CONTACT: [MessageHandler(filters.TEXT & ~filters.COMMAND, bug_contact)],
-                BUG_CONFIRMATION: [CallbackQueryHandler(confirm_bug, pattern='^confirm_bug$'),
-                                   CallbackQueryHandler(cancel_bug, pattern='^cancel_bug$')],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(bug_handler)
-
-        contact_handler = ConversationHandler(
-            entry_points=[CommandHandler('contact', contact_start)],
-            states={
-                CONTACT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, contact_name)],
-                CONTACT_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, contact_email)],
-                CONTACT_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, contact_message)],
-                CONTACT_CONFIRMATION: [CallbackQueryHandler(confirm_contact, pattern='^confirm_contact$'),
-                                       CallbackQueryHandler(cancel_contact, pattern='^cancel_contact$')],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(contact_handler)
-
-        subscribe_handler = ConversationHandler(
-            entry_points=[CommandHandler('subscribe', subscribe_command)],
-            states={
-                SUBSCRIBE_CONFIRMATION: [CallbackQueryHandler(confirm_subscribe, pattern='^confirm_subscribe$'),
-                                         CallbackQueryHandler(cancel_subscribe, pattern='^cancel_subscribe$')],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(subscribe_handler)
+        instrument_handlers(handler for group in application.handlers.values() for handler in group)
+        update_prefilter = UpdatePrefilter(application)
+        logger.info("Manejadores del bot cargados.")
 
-        unsubscribe_handler = ConversationHandler(
-            entry_points=[CommandHandler('unsubscribe', unsubscribe_command)],
-            states={
-                UNSUBSCRIBE_CONFIRMATION: [CallbackQueryHandler(confirm_unsubscribe, pattern='^confirm_unsubscribe$'),
-                                           CallbackQueryHandler(cancel_unsubscribe, pattern='^cancel_unsubscribe$')],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(unsubscribe_handler)
+        await application.initialize()
+        await application.start()
 
-        check_status_handler = ConversationHandler(
-            entry_points=[CommandHandler('check_status', check_status_start)],
-            states={
-                CHECK_STATUS_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, check_status_id)],
-            },
-            fallbacks=[CommandHandler('cancel', cancel_command)],
-        )
-        application.add_handler(check_status_handler)
+        # Establece la URL del webhook en Telegram (solo un worker por contenedor)
+        if webhook_lock.try_acquire():
+            await application.bot.set_webhook(url=WEBHOOK_URL)
+            logger.info("Webhook configurado en la URL: %s", WEBHOOK_URL)
+        else:
+            logger.info("Otro worker ya ha configurado el webhook.")
 
-        webapp_handler = CommandHandler('webapp', webapp_start)
-        application.add_handler(webapp_handler)
-        application.add_handler(CommandHandler('help', help_command))
+        outbound_queue.start(application.bot)
+        loop_lag_monitor.start()
+        shared_log_levels.start()
+        analytics.start()
 
-        logger.info("Manejadores del bot cargados.")
+        # Precarga en segundo plano de los usuarios registrados
+        warm_task = asyncio.create_task(registration_cache.warm())
 
-        # Establece la URL del webhook en Telegram
-        await application.bot.set_webhook(url=WEBHOOK_URL)
-        logger.info(f"Webhook configurado en la URL: {WEBHOOK_URL}")
+        # Tareas en segundo plano: se ejecutan solo en la instancia líder
+        await leader_election.start(application)
 
+        # Al recibir SIGTERM se vacían ya los datos en memoria: el cierre del lifespan
+        # no empieza hasta que uvicorn ha esperado a las peticiones en curso
+        shutdown_coordinator.on_drain(analytics.flush)
+        shutdown_coordinator.on_drain(flush_notices_and_spans)
+        shutdown_coordinator.install_signal_handler()
+        shutdown_coordinator.mark_ready()
         yield
     except Exception as e:
-        logger.error(f"Error durante la inicialización de la aplicación: {e}")
+        logger.error("Error durante la inicialización de la aplicación: %s", e)
         sys.exit(1)
     finally:
+        # 1. Deja de aceptar webhooks (si SIGTERM no lo ha hecho ya) y espera a las
+        #    difusiones en curso, que guardan su checkpoint al ver que el proceso se detiene
+        shutdown_coordinator.begin_drain()
+        await shutdown_coordinator.wait_idle()
+        if warm_task is not None:
+            warm_task.cancel()
+        await leader_election.stop()
+        # 2. Espera a las tareas lanzadas con application.create_task
+        if application is not None and application.running:
+            await application.stop()
+        # 3. Vacía lo que se haya acumulado desde SIGTERM: analítica, avisos, cola de salida y trazas
+        await analytics.stop()
+        status_notifier.flush_all()
+        await outbound_queue.stop(timeout=max(shutdown_coordinator.remaining(), 1.0))
+        tracer_provider.force_flush(timeout_millis=500)
+        await shard_router.close()
+        await loop_lag_monitor.stop()
+        await shared_log_levels.stop()
+        webhook_lock.release()
+        if application is not None:
+            await application.shutdown()
+        shutdown_coordinator.mark_stopped()
         logger.info("Apagando aplicación FastAPI...")
 
 app = FastAPI(lifespan=lifespan)
@@ -948,23 +3113,161 @@ async def webhook_handler(request: Request):
     if application is None:
         logger.error("La aplicación de Telegram no se ha inicializado.")
         raise HTTPException(status_code=500, detail="Bot application not initialized.")
-        
+    if not shutdown_coordinator.accepting:
+        # Telegram reintenta la entrega y la recibirá la nueva revisión
+        raise HTTPException(status_code=503, detail="Shutting down.")
+    shutdown_coordinator.track(asyncio.current_task())
+
+    forwarded_update_id = None
     try:
-        data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.process_update(update)
+        with tracer.start_as_current_span("webhook update", kind=SpanKind.SERVER) as root_span:
+            # Se lee el cuerpo una sola vez; el reenvío entre instancias usa los mismos bytes
+            body = await request.body()
+            data = json_loads(body)
+            root_span.set_attribute('telegram.update_id', data.get('update_id', 0))
+
+            # En modo sharding, los chats de otra instancia se reenvían a su propietaria
+            if shard_router.enabled and SHARD_FORWARDED_HEADER not in request.headers:
+                owner = shard_router.owner_for(data)
+                if owner != shard_router.self_url:
+                    root_span.set_attribute('shard.forwarded_to', owner)
+                    outcome = await shard_router.forward(owner, body, data.get('update_id', 0))
+                    if outcome == FORWARD_DELIVERED:
+                        return {"status": "forwarded"}
+                    if outcome == FORWARD_FAILED:
+                        # El propietario pudo procesarla: Telegram la reintentará y se deduplicará allí
+                        raise HTTPException(status_code=503, detail="Shard owner unavailable.")
+                    # FORWARD_UNREACHABLE: el cuerpo no se entregó, se procesa aquí
+            elif SHARD_UPDATE_ID_HEADER in request.headers:
+                forwarded_update_id = request.headers[SHARD_UPDATE_ID_HEADER]
+                if not forwarded_updates.first_seen(forwarded_update_id):
+                    root_span.set_attribute('shard.duplicate', True)
+                    return {"status": "duplicate"}
+
+            # Ningún handler podría aceptarla: se descarta sin construir el Update
+            if update_prefilter is not None and not update_prefilter.should_process(data):
+                root_span.set_attribute('telegram.update_ignored', True)
+                return {"status": "ignored"}
+
+            decode_cpu, decode_wall = thread_time(), monotonic()
+            update = Update.de_json(data, application.bot)
+            handler_cpu_stats.record('Update.de_json', thread_time() - decode_cpu, monotonic() - decode_wall)
+            log_update_id.set(update.update_id)
+            log_user_id.set(update.effective_user.id if update.effective_user else None)
+            # Incluye la evaluación de filtros de todos los handlers y el propio handler
+            dispatch = CPUTimedAwaitable(application.process_update(update))
+            dispatch_wall = monotonic()
+            await dispatch
+            handler_cpu_stats.record('Application.process_update', dispatch.cpu, monotonic() - dispatch_wall)
 
         return {"status": "ok"}
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error al procesar la actualización: {e}")
+        logger.exception("Error al procesar la actualización: %s", e)
+        if forwarded_update_id is not None:
+            # No se ha procesado: el reintento de Telegram no debe tomarse por un duplicado
+            forwarded_updates.forget(forwarded_update_id)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Servidor FastAPI iniciado.")
+# --- ENDPOINTS DE ADMINISTRACIÓN ---
+
+def require_admin_token(request: Request) -> None:
+    """Dependencia de FastAPI: exige la cabecera X-Admin-Token."""
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found.")
+    if not secrets.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden.")
+
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    if application and application.running:
-        await application.stop()
-        logger.info("Aplicación del bot de Telegram detenida.")
+@app.get("/admin/log-level", dependencies=[Depends(require_admin_token)])
+async def get_log_levels():
+    loggers = {'root': logging.getLevelName(logging.getLogger().level)}
+    for name, other in logging.Logger.manager.loggerDict.items():
+        if isinstance(other, logging.Logger) and other.level != logging.NOTSET:
+            loggers[name] = logging.getLevelName(other.level)
+    return {'levels': loggers, 'sample_rates': LOG_SAMPLE_RATES}
+
+
+@app.put("/admin/log-level", dependencies=[Depends(require_admin_token)])
+async def set_log_level(request: Request):
+    """
+    Cambia el nivel de un logger en caliente: {"logger": "telegram", "level": "DEBUG"}.
+    Se aplica ya en este worker y en unos segundos en los demás del contenedor;
+    las otras instancias de Cloud Run no lo ven.
+    """
+    body = await request.json()
+    level = str(body.get('level', '')).upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise HTTPException(status_code=400, detail=f"Invalid level: {level}")
+    name = body.get('logger') or None
+    shared_log_levels.set(name, level)
+    logger.info("Nivel de log de %s cambiado a %s.", name or 'root', level)
+    return {'logger': name or 'root', 'level': level, 'sync_interval': LOG_LEVEL_SYNC_INTERVAL}
+
+@app.post("/admin/reports/status", dependencies=[Depends(require_admin_token)])
+async def set_reports_status(request: Request):
+    """Cambio de estado masivo: {"status": "Resuelto", "report_ids": ["...", ...]}."""
+    body = await request.json()
+    new_status = body.get('status')
+    report_ids = body.get('report_ids') or []
+    if new_status not in REPORT_TRANSITIONS or not isinstance(report_ids, list):
+        raise HTTPException(status_code=400, detail="Invalid status or report_ids.")
+    return await update_report_statuses([str(report_id) for report_id in report_ids], new_status)
+
+@app.get("/admin/analytics", dependencies=[Depends(require_admin_token)])
+async def get_analytics(days: int = 30):
+    """Agregados precalculados de los últimos `days` días (los de hoy, con hasta un intervalo de retraso)."""
+    days = min(max(days, 1), ANALYTICS_MAX_DAYS)
+    return await firestore_call('analytics.read', _read_rollups, days)
+
+@app.get("/debug/profile", dependencies=[Depends(require_admin_token)])
+async def debug_profile(seconds: float = 10, interval_ms: float = 5):
+    """Captura el hilo del bucle de eventos durante `seconds` y devuelve pilas "collapsed"."""
+    if loop_lag_monitor.loop_thread_id is None:
+        raise HTTPException(status_code=503, detail="Profiler not ready.")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile capture is already running.")
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    async with profile_lock:
+        collapsed = await asyncio.to_thread(
+            sample_stacks, loop_lag_monitor.loop_thread_id, seconds, max(interval_ms, 1) / 1000
+        )
+    return PlainTextResponse(
+        collapsed,
+        headers={'Content-Disposition': 'attachment; filename="profile.collapsed"'},
+    )
+
+
+@app.get("/debug/handlers", dependencies=[Depends(require_admin_token)])
+async def debug_handlers():
+    return handler_cpu_stats.snapshot()
+
+
+@app.get("/debug/loop", dependencies=[Depends(require_admin_token)])
+async def debug_loop():
+    return loop_lag_monitor.snapshot()
+
+# --- SONDAS DE SALUD ---
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: el proceso responde mientras no haya terminado de apagarse."""
+    if shutdown_coordinator.phase == ShutdownCoordinator.STOPPED:
+        raise HTTPException(status_code=503, detail=shutdown_coordinator.phase)
+    return {'status': 'ok', 'phase': shutdown_coordinator.phase}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: solo acepta tráfico en la fase "ready"."""
+    if not shutdown_coordinator.accepting:
+        raise HTTPException(status_code=503, detail=shutdown_coordinator.phase)
+    return {'status': 'ready', 'phase': shutdown_coordinator.phase}
+
+if __name__ == "__main__":
+    import uvicorn
+    if len(sys.argv) > 2 and sys.argv[1] == "--local-shards":
+        run_local_shards(int(sys.argv[2]))
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8080, timeout_graceful_shutdown=SHUTDOWN_HTTP_TIMEOUT)
@@ -0,0 +1,13 @@
+"""
+Configuración común de los tests. main.py crea el cliente de Firestore al
+importarse: apuntándolo al emulador no hace falta ni conexión ni credenciales,
+porque estos tests solo ejercitan piezas que no llegan a llamar a Firestore.
+"""
+import os
+import sys
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8081")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-reportebot")
+os.environ.setdefault("STATE_STORE", "memory")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
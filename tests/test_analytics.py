@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ConversationHandler
+
+import main
+
+
+def hll_of(values):
+    hll = main.HyperLogLog()
+    for value in values:
+        hll.add(str(value))
+    return hll
+
+
+def test_hll_counts_small_sets_almost_exactly():
+    assert main.HyperLogLog().count() == 0
+    assert abs(hll_of(range(100)).count() - 100) <= 2
+    # Repetir valores no cambia la estimación
+    assert hll_of(list(range(100)) * 5).count() == hll_of(range(100)).count()
+
+
+def test_hll_estimates_large_sets_within_error():
+    assert abs(hll_of(range(50000)).count() - 50000) / 50000 < 0.05
+
+
+def test_hll_merge_estimates_the_union():
+    left, right = hll_of(range(0, 6000)), hll_of(range(4000, 10000))
+    left.merge(right)
+    assert abs(left.count() - 10000) / 10000 < 0.05
+
+
+def test_hll_round_trips_through_registers():
+    original = hll_of(range(1000))
+    restored = main.HyperLogLog(registers=bytes(original.registers))
+    assert restored.count() == original.count()
+
+
+def test_nest_expands_dotted_paths():
+    assert main._nest({'a.b': 1, 'a.c.d': 2, 'e': 3}) == {'a': {'b': 1, 'c': {'d': 2}}, 'e': 3}
+
+
+def fake_update(user_id, text=None):
+    message = SimpleNamespace(text=text) if text is not None else None
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_message=message)
+
+
+def test_record_handler_counts_commands_and_funnel_steps():
+    rollup = main.AnalyticsRollup(60)
+    funnel_names = {0: 'REGISTER_NAME', 1: 'REGISTER_EMAIL'}
+
+    rollup.record_handler(fake_update(1, '/Report@ReporteBot algo'), 'report_command', None, True, None)
+    rollup.record_handler(fake_update(1), 'register_callback', 0, False, ('register', main.FUNNEL_ENTRY, funnel_names))
+    rollup.record_handler(fake_update(2), 'register_name', 1, False, ('register', 0, funnel_names))
+    # Repetir el mismo estado (p. ej. un email inválido) no cuenta como avance
+    rollup.record_handler(fake_update(2), 'register_email', 1, False, ('register', 1, funnel_names))
+    rollup.record_handler(fake_update(2), 'register_email', ConversationHandler.END, False, ('register', 1, funnel_names))
+
+    (counters,) = rollup._counters.values()
+    assert counters == {
+        'commands.report': 1,
+        'funnel.register.start': 1,
+        'funnel.register.REGISTER_NAME': 1,
+        'funnel.register.REGISTER_EMAIL': 1,
+        'funnel.register.end.register_email': 1,
+    }
+    (visitors,) = rollup._visitors.values()
+    assert visitors.count() == 2
+
+
+def test_flush_requeues_only_the_days_that_failed():
+    rollup = main.AnalyticsRollup(60)
+    rollup._counters = {'2025-01-01': {'commands.start': 2}, '2025-01-02': {'commands.start': 3}}
+    rollup._visitors = {'2025-01-01': hll_of(range(10)), '2025-01-02': hll_of(range(20))}
+    written = []
+
+    def write(counters, visitors):
+        written.append((dict(counters), dict(visitors)))
+        return ['2025-01-02']
+
+    rollup._write = write
+    asyncio.run(rollup.flush())
+
+    assert set(written[0][0]) == {'2025-01-01', '2025-01-02'}
+    assert rollup._counters == {'2025-01-02': {'commands.start': 3}}
+    assert set(rollup._visitors) == {'2025-01-02'}
+
+
+class FakeRef:
+    def __init__(self, day_id):
+        self.id = day_id
+
+
+class FakeDB:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def collection(self, name):
+        assert name == 'analytics_daily'
+        return SimpleNamespace(document=FakeRef)
+
+    def get_all(self, refs):
+        for ref in refs:
+            data = self.documents.get(ref.id)
+            yield SimpleNamespace(id=ref.id, exists=data is not None, to_dict=lambda data=data: data)
+
+
+@pytest.fixture
+def fixed_today(monkeypatch):
+    monkeypatch.setattr(main, 'utc_now', lambda: datetime(2025, 3, 10, 12, 0, tzinfo=timezone.utc))
+
+
+def test_read_rollups_aggregates_days_by_id(monkeypatch, fixed_today):
+    monkeypatch.setattr(main, 'db', FakeDB({
+        '2025-03-09': {
+            'dau': 2, 'dau_registers': bytes(hll_of(['1', '2']).registers),
+            'commands': {'start': 3, 'report': 1},
+            'funnel': {'register': {'start': 4, 'REGISTER_NAME': 2, 'end': {'register_email': 1}}},
+            'subscribers': {'joined': 2},
+        },
+        '2025-03-10': {
+            'dau': 2, 'dau_registers': bytes(hll_of(['2', '3']).registers),
+            'commands': {'report': 5},
+            'funnel': {'register': {'start': 0, 'end': {'register_email': 1}}},
+            'users': {'registered': 1},
+            'subscribers': {'left': 1},
+        },
+    }))
+
+    result = main._read_rollups(3)
+
+    assert (result['from'], result['to']) == ('2025-03-08', '2025-03-10')
+    assert result['distinct_users'] == 3
+    assert result['commands'] == {'report': 6, 'start': 3}
+    assert list(result['commands']) == ['report', 'start']
+    register = result['funnels']['register']
+    assert register['end'] == {'register_email': 2}
+    assert register['conversion'] == {'REGISTER_NAME': 0.5}
+    assert [day['subscribers_net_cumulative'] for day in result['daily']] == [0, 2, 1]
+    assert result['daily'][0] == {
+        'day': '2025-03-08', 'dau': 0, 'registered': 0,
+        'subscribers_joined': 0, 'subscribers_left': 0, 'subscribers_net_cumulative': 0,
+    }
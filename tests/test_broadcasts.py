@@ -0,0 +1,183 @@
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+from google.api_core.exceptions import AlreadyExists
+
+import main
+
+
+class FakeDocument:
+    def __init__(self, db, collection, doc_id):
+        self.db, self.collection, self.id = db, collection, doc_id
+
+    @property
+    def _data(self):
+        return self.db.data.setdefault(self.collection, {})
+
+    def get(self):
+        data = self._data.get(self.id)
+        return SimpleNamespace(id=self.id, exists=data is not None, to_dict=lambda: dict(data) if data else None)
+
+    def create(self, fields):
+        if self.id in self._data:
+            raise AlreadyExists(self.id)
+        self._data[self.id] = dict(fields)
+
+    def update(self, fields):
+        self._data[self.id].update(fields)
+
+
+class FakeQuery:
+    def __init__(self, db, collection, after=None, size=None, filters=()):
+        self.db, self.collection, self.after, self.size, self.filters = db, collection, after, size, filters
+
+    def _copy(self, **changes):
+        fields = {'after': self.after, 'size': self.size, 'filters': self.filters, **changes}
+        return FakeQuery(self.db, self.collection, **fields)
+
+    def select(self, fields):
+        assert [str(field) for field in fields] == ['__name__']
+        return self
+
+    def order_by(self, field):
+        return self
+
+    def limit(self, size):
+        return self._copy(size=size)
+
+    def start_after(self, values):
+        return self._copy(after=values['__name__'])
+
+    def where(self, filter):
+        return self._copy(filters=self.filters + (filter,))
+
+    def stream(self):
+        docs = sorted(self.db.data.get(self.collection, {}).items())
+        docs = [(doc_id, data) for doc_id, data in docs if self.after is None or doc_id > self.after]
+        for field_filter in self.filters:
+            assert field_filter.op_string == 'in'
+            docs = [(doc_id, data) for doc_id, data in docs if data[field_filter.field_path] in field_filter.value]
+        for doc_id, data in docs[:self.size]:
+            yield SimpleNamespace(id=doc_id, to_dict=lambda data=data: dict(data))
+
+
+class FakeFirestore:
+    def __init__(self, users):
+        self.data = {'users': {user_id: {} for user_id in users}}
+
+    def collection(self, name):
+        db = self
+
+        class Collection(FakeQuery):
+            def document(self, doc_id=None):
+                return FakeDocument(db, name, doc_id)
+
+        return Collection(self, name)
+
+
+class FakeBot:
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+        if self.on_send:
+            self.on_send(len(self.sent))
+
+
+USERS = [f"u{index:02d}" for index in range(7)]
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeFirestore(USERS)
+    monkeypatch.setattr(main, 'db', db)
+    monkeypatch.setattr(main, 'BROADCAST_PAGE_SIZE', 3)
+    monkeypatch.setattr(main, 'BROADCAST_CHECKPOINT_EVERY', 2)
+    coordinator = main.ShutdownCoordinator(drain_timeout=1, grace_period=0)
+    coordinator.mark_ready()
+    monkeypatch.setattr(main, 'shutdown_coordinator', coordinator)
+    return db
+
+
+def test_broadcast_reaches_every_user_across_pages(fake_db):
+    bot = FakeBot()
+
+    async def scenario():
+        job_id = await main.create_broadcast("Hola", 1, "1-10")
+        return await main.run_broadcast(bot, job_id)
+
+    assert asyncio.run(scenario())
+    assert [chat_id for chat_id, _ in bot.sent] == USERS
+    job = fake_db.data['broadcast_jobs']['1-10']
+    assert (job['status'], job['processed'], job['cursor']) == (main.BROADCAST_STATUS_DONE, 7, 'u06')
+
+
+def test_redelivered_request_does_not_create_a_second_job(fake_db):
+    async def scenario():
+        return await main.create_broadcast("Hola", 1, "1-10"), await main.create_broadcast("Hola", 1, "1-10")
+
+    assert asyncio.run(scenario()) == ("1-10", None)
+
+
+def test_interrupted_broadcast_resumes_from_its_checkpoint(fake_db, monkeypatch):
+    # SIGTERM llega durante el cuarto envío
+    first_bot = FakeBot(on_send=lambda sent: sent == 4 and main.shutdown_coordinator.begin_drain())
+
+    async def first_run():
+        job_id = await main.create_broadcast("Hola", 1, "1-10")
+        return await main.run_broadcast(first_bot, job_id)
+
+    assert not asyncio.run(first_run())
+    job = fake_db.data['broadcast_jobs']['1-10']
+    assert (job['status'], job['processed'], job['cursor']) == (main.BROADCAST_STATUS_INTERRUPTED, 4, 'u03')
+
+    # La nueva revisión retoma el trabajo desde el cursor
+    coordinator = main.ShutdownCoordinator(drain_timeout=1, grace_period=0)
+    coordinator.mark_ready()
+    monkeypatch.setattr(main, 'shutdown_coordinator', coordinator)
+    second_bot = FakeBot()
+    asyncio.run(main.resume_broadcasts(SimpleNamespace(bot=second_bot)))
+
+    assert [chat_id for chat_id, _ in first_bot.sent + second_bot.sent] == USERS
+    assert fake_db.data['broadcast_jobs']['1-10']['status'] == main.BROADCAST_STATUS_DONE
+
+
+def test_only_interrupted_or_stale_jobs_are_resumed(fake_db):
+    now = main.utc_now()
+    fake_db.data['broadcast_jobs'] = {
+        'fresh': {'status': main.BROADCAST_STATUS_RUNNING, 'updated_at': now},
+        'stale': {'status': main.BROADCAST_STATUS_RUNNING, 'updated_at': now - timedelta(minutes=10)},
+        'interrupted': {'status': main.BROADCAST_STATUS_INTERRUPTED, 'updated_at': now},
+        'done': {'status': main.BROADCAST_STATUS_DONE, 'updated_at': now - timedelta(minutes=10)},
+    }
+    assert main._pending_broadcasts() == ['interrupted', 'stale']
+
+
+def test_admin_gets_an_immediate_reply_and_a_final_notice(fake_db):
+    bot = FakeBot()
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    update = SimpleNamespace(
+        effective_chat=SimpleNamespace(id=1),
+        effective_user=SimpleNamespace(id=1, language_code='es'),
+        message=SimpleNamespace(message_id=10, text="Hola", reply_text=reply_text),
+    )
+
+    async def scenario():
+        state = await main.launch_broadcast(update, SimpleNamespace(bot=bot))
+        # La respuesta sale antes de que empiece el envío
+        assert replies == [main.messages.render('es', 'broadcast_started')] and bot.sent == []
+        # El trabajo en segundo plano está registrado para el drenaje
+        await main.shutdown_coordinator.wait_idle()
+        return state
+
+    assert asyncio.run(scenario()) == main.ConversationHandler.END
+    assert [chat_id for chat_id, _ in bot.sent] == USERS + [1]
+    assert bot.sent[-1][1] == main.messages.render('es', 'broadcast_sent')
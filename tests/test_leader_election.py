@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_file_lease_is_exclusive_until_ttl_expires(tmp_path):
+    backend = main.FileLeaseBackend(str(tmp_path / "leases.json"))
+
+    assert run(backend.try_acquire("job:a", "one", 0.3))
+    assert not run(backend.try_acquire("job:a", "two", 0.3))
+    # El titular puede renovar
+    assert run(backend.try_acquire("job:a", "one", 0.3))
+
+    time.sleep(0.35)
+    assert run(backend.try_acquire("job:a", "two", 0.3))
+    assert not run(backend.try_acquire("job:a", "one", 0.3))
+
+
+def test_file_lease_release_lets_another_holder_in(tmp_path):
+    backend = main.FileLeaseBackend(str(tmp_path / "leases.json"))
+    assert run(backend.try_acquire("job:a", "one", 60))
+
+    # Solo el titular puede liberarlo
+    run(backend.release("job:a", "two"))
+    assert not run(backend.try_acquire("job:a", "two", 60))
+
+    run(backend.release("job:a", "one"))
+    assert run(backend.try_acquire("job:a", "two", 60))
+
+
+def test_file_lease_leases_are_independent(tmp_path):
+    backend = main.FileLeaseBackend(str(tmp_path / "leases.json"))
+    assert run(backend.try_acquire("job:a", "one", 60))
+    assert run(backend.try_acquire("job:b", "two", 60))
+
+
+def test_only_one_instance_runs_the_job_and_the_other_takes_over(tmp_path):
+    backend = main.FileLeaseBackend(str(tmp_path / "leases.json"))
+    runs = []
+
+    def elector(holder):
+        election = main.LeaderElection(backend, holder, ttl=0.3)
+
+        async def job(application):
+            runs.append(holder)
+
+        election.register("cleanup", job, interval=0.05)
+        return election
+
+    async def scenario():
+        first, second = elector("one"), elector("two")
+        await first.start(None)
+        await asyncio.sleep(0.05)
+        await second.start(None)
+        await asyncio.sleep(0.4)
+        ran_before = set(runs)
+
+        # Al parar, el líder libera el lease y la otra instancia lo toma
+        await first.stop()
+        runs.clear()
+        await asyncio.sleep(0.4)
+        await second.stop()
+        return ran_before, set(runs)
+
+    ran_before, ran_after = run(scenario())
+    assert ran_before == {"one"}
+    assert ran_after == {"two"}
@@ -0,0 +1,80 @@
+import json
+import logging
+import logging.config
+import queue
+
+import uvicorn.config
+
+import main
+
+
+def make_record(msg="hola %s", args=("mundo",), category=None, exc_info=None):
+    record = logging.LogRecord('reportebot', logging.ERROR, __file__, 1, msg, args, exc_info)
+    if category is not None:
+        record.category = category
+    return record
+
+
+def test_sampling_drops_only_sampled_categories():
+    sampling = main.SamplingFilter({'noisy': 0.0, 'kept': 1.0})
+    assert not sampling.filter(make_record(category='noisy'))
+    assert sampling.filter(make_record(category='kept'))
+    assert sampling.filter(make_record())
+
+
+def test_json_formatter_emits_cloud_logging_fields():
+    record = make_record(category='broadcast.recipient_error')
+    record.update_id, record.user_id, record.handler = 7, 42, None
+
+    entry = json.loads(main.JsonFormatter().format(record))
+
+    assert entry['severity'] == 'ERROR'
+    assert entry['logger'] == 'reportebot'
+    assert entry['message'] == 'hola mundo'
+    assert (entry['update_id'], entry['user_id'], entry['category']) == (7, 42, 'broadcast.recipient_error')
+    assert 'handler' not in entry and 'exception' not in entry
+    assert entry['timestamp'].endswith('+00:00')
+
+
+def test_exception_survives_the_queue():
+    log_queue = queue.SimpleQueue()
+    test_logger = logging.getLogger('tests.queue')
+    test_logger.propagate = False
+    test_logger.addHandler(main.StructuredQueueHandler(log_queue))
+    try:
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            test_logger.exception("Error al procesar %s", "la actualización")
+    finally:
+        test_logger.handlers.clear()
+
+    record = log_queue.get_nowait()
+    entry = json.loads(main.JsonFormatter().format(record))
+
+    assert entry['message'] == 'Error al procesar la actualización'
+    assert 'ValueError: boom' in entry['exception']
+    assert record.args is None
+
+
+def test_uvicorn_loggers_are_routed_through_the_queue():
+    logging.config.dictConfig(uvicorn.config.LOGGING_CONFIG)
+    main.route_uvicorn_logs()
+    for name in ('uvicorn', 'uvicorn.access'):
+        assert logging.getLogger(name).handlers == [main.queue_handler]
+    # uvicorn.error propaga a "uvicorn"
+    assert logging.getLogger('uvicorn.error').propagate
+
+
+def test_log_levels_reach_every_worker(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    first = main.SharedLogLevels(main.SQLiteStateStore(path), interval=60)
+    second = main.SharedLogLevels(main.SQLiteStateStore(path), interval=60)
+    target = logging.getLogger('tests.levels')
+    target.setLevel(logging.INFO)
+
+    first.set('tests.levels', 'DEBUG')
+    target.setLevel(logging.INFO)
+    # El otro worker lo aplica en su siguiente sincronización
+    second.apply()
+    assert target.level == logging.DEBUG
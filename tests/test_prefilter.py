@@ -0,0 +1,67 @@
+import pytest
+from telegram.ext import ApplicationBuilder, MessageHandler, TypeHandler, filters
+from telegram import Update
+
+import main
+
+
+def build_application():
+    return ApplicationBuilder().token("1:test").updater(None).build()
+
+
+def text_update(text, command_length=None, key='message'):
+    message = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': text}
+    if command_length is not None:
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': command_length}]
+    return {'update_id': 1, key: message}
+
+
+def callback_update(data):
+    return {'update_id': 1, 'callback_query': {'id': '1', 'from': {'id': 1}, 'chat_instance': 'x', 'data': data}}
+
+
+@pytest.fixture(scope='module')
+def prefilter():
+    application = build_application()
+    main.register_handlers(application)
+    return main.UpdatePrefilter(application)
+
+
+def test_keeps_registered_commands(prefilter):
+    assert prefilter.should_process(text_update('/start', 6))
+    assert prefilter.should_process(text_update('/report', 7))
+    assert prefilter.should_process(text_update('/START@ReporteBot', 17))
+
+
+def test_drops_unknown_commands(prefilter):
+    assert not prefilter.message_handlers_take_commands
+    assert not prefilter.should_process(text_update('/nope', 5))
+
+
+def test_keeps_plain_text_for_conversations(prefilter):
+    assert prefilter.should_process(text_update('hola'))
+    assert prefilter.should_process(text_update('hola', key='edited_message'))
+
+
+def test_filters_callbacks_by_registered_patterns(prefilter):
+    assert prefilter.should_process(callback_update('register'))
+    assert prefilter.should_process(callback_update('confirm_feedback'))
+    assert not prefilter.should_process(callback_update('register_now'))
+    assert not prefilter.should_process(callback_update('unknown'))
+
+
+def test_drops_update_types_without_handler(prefilter):
+    assert not prefilter.should_process({'update_id': 1, 'my_chat_member': {'chat': {'id': 1}}})
+    assert not prefilter.should_process({'update_id': 1, 'poll': {'id': 'p'}})
+
+
+def test_keeps_unknown_commands_when_a_message_handler_accepts_them():
+    application = build_application()
+    application.add_handler(MessageHandler(filters.TEXT, lambda update, context: None))
+    assert main.UpdatePrefilter(application).should_process(text_update('/nope', 5))
+
+
+def test_unknown_handler_types_disable_the_filter():
+    application = build_application()
+    application.add_handler(TypeHandler(Update, lambda update, context: None))
+    assert main.UpdatePrefilter(application).should_process({'update_id': 1, 'poll': {'id': 'p'}})
@@ -0,0 +1,107 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def shared_store(tmp_path):
+    return str(tmp_path / "state.sqlite3")
+
+
+def test_unknown_user_needs_firestore():
+    cache = main.RegistrationCache(main.MemoryStateStore(), negative_ttl=60)
+    assert cache.lookup(1) is None
+
+
+def test_registered_and_unregistered_users_are_cached():
+    cache = main.RegistrationCache(main.MemoryStateStore(), negative_ttl=60)
+    cache.record(1, True)
+    cache.record(2, False)
+    assert cache.lookup(1) is True
+    assert cache.lookup(2) is False
+
+
+def test_negative_entries_expire():
+    cache = main.RegistrationCache(main.MemoryStateStore(), negative_ttl=-1)
+    cache.record(2, False)
+    assert cache.lookup(2) is None
+
+
+def test_registration_invalidates_every_worker(shared_store):
+    first = main.RegistrationCache(main.SQLiteStateStore(shared_store), negative_ttl=60)
+    second = main.RegistrationCache(main.SQLiteStateStore(shared_store), negative_ttl=60)
+
+    first.record(2, False)
+    assert second.lookup(2) is False
+
+    # El registro ocurre en el otro worker
+    second.mark_registered(2)
+    assert first.lookup(2) is None
+    assert second.lookup(2) is True
+
+
+def test_negative_entries_are_pruned(monkeypatch):
+    store = main.MemoryStateStore()
+    cache = main.RegistrationCache(store, negative_ttl=-1)
+    monkeypatch.setattr(cache, 'PRUNE_EVERY', 3)
+    for user_id in range(3):
+        cache.record(user_id, False)
+    assert store.prune(cache.NAMESPACE) == 1
+
+
+class CountingUsers:
+    """Colección `users` falsa que cuenta las lecturas."""
+
+    def __init__(self, registered):
+        self.registered = registered
+        self.gets = 0
+
+    def collection(self, name):
+        assert name == 'users'
+        return self
+
+    def document(self, user_id):
+        def get():
+            self.gets += 1
+            return SimpleNamespace(exists=user_id in self.registered)
+        return SimpleNamespace(get=get)
+
+
+def test_check_user_registered_reads_firestore_once_per_ttl(monkeypatch):
+    users = CountingUsers(registered={'1'})
+    monkeypatch.setattr(main, 'db', users)
+    monkeypatch.setattr(main, 'registration_cache', main.RegistrationCache(main.MemoryStateStore(), 60))
+
+    async def scenario():
+        return [await main.check_user_registered(user_id) for user_id in (1, 1, 2, 2, 2)]
+
+    assert asyncio.run(scenario()) == [True, True, False, False, False]
+    assert users.gets == 2
+
+
+def test_warm_scan_only_requests_document_names(monkeypatch):
+    selected = []
+
+    class Query:
+        def select(self, fields):
+            selected.append([str(field) for field in fields])
+            return self
+
+        def order_by(self, field):
+            return self
+
+        def limit(self, count):
+            return self
+
+        def stream(self):
+            return iter([SimpleNamespace(id='10'), SimpleNamespace(id='20')])
+
+    monkeypatch.setattr(main, 'db', SimpleNamespace(collection=lambda name: Query()))
+    cache = main.RegistrationCache(main.MemoryStateStore(), 60)
+    asyncio.run(cache.warm())
+
+    assert selected == [['__name__']]
+    assert cache.lookup(10) is True and cache.lookup(20) is True
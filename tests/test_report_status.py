@@ -0,0 +1,192 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from google.api_core.exceptions import FailedPrecondition
+from telegram.error import BadRequest, RetryAfter
+
+import main
+
+
+class FakeReports:
+    """Colección `reports` falsa con precondiciones de `update_time`, como Firestore."""
+
+    def __init__(self, reports):
+        self.docs = {report_id: dict(report) for report_id, report in reports.items()}
+        self.versions = {report_id: 0 for report_id in reports}
+        self.commits = []
+        self.after_read = None
+
+    def collection(self, name):
+        assert name == 'reports'
+        return self
+
+    def document(self, report_id):
+        return report_id
+
+    def get_all(self, refs):
+        snapshots = [
+            SimpleNamespace(
+                id=ref, reference=ref, exists=ref in self.docs, update_time=self.versions.get(ref),
+                to_dict=lambda data=dict(self.docs.get(ref, {})): data,
+            )
+            for ref in refs
+        ]
+        if self.after_read:
+            self.after_read(self)
+        return iter(snapshots)
+
+    def write_option(self, last_update_time):
+        return last_update_time
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def write(self, report_id, fields):
+        self.docs[report_id].update(fields)
+        self.versions[report_id] += 1
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def update(self, ref, fields, option):
+        self.writes.append((ref, fields, option))
+
+    def commit(self):
+        for ref, _, expected_version in self.writes:
+            if self.db.versions[ref] != expected_version:
+                raise FailedPrecondition(f"{ref} changed")
+        for ref, fields, _ in self.writes:
+            self.db.write(ref, {'status': fields['status']})
+        self.db.commits.append(len(self.writes))
+
+
+@pytest.fixture
+def reports(monkeypatch):
+    db = FakeReports({
+        'pending': {'status': main.REPORT_STATUS_PENDING, 'user_id': 1, 'locale': 'en'},
+        'legacy': {'user_id': 2},
+        'review': {'status': main.REPORT_STATUS_IN_REVIEW, 'user_id': 1},
+        'resolved': {'status': main.REPORT_STATUS_RESOLVED, 'user_id': 3},
+    })
+    monkeypatch.setattr(main, 'db', db)
+    return db
+
+
+def test_only_allowed_transitions_are_written(reports):
+    result = main._apply_status_changes(['pending', 'legacy', 'review', 'resolved', 'missing'],
+                                        main.REPORT_STATUS_IN_REVIEW)
+
+    assert result['updated'] == [('pending', 1, 'en'), ('legacy', 2, None)]
+    assert result['skipped'] == ['review', 'resolved', 'missing']
+    assert reports.docs['legacy']['status'] == main.REPORT_STATUS_IN_REVIEW
+    assert reports.docs['resolved']['status'] == main.REPORT_STATUS_RESOLVED
+
+
+def test_conflicting_write_is_retried_and_revalidated(reports):
+    def resolve_concurrently(db):
+        # Otro administrador resuelve el reporte entre la lectura y la escritura
+        db.after_read = None
+        db.write('pending', {'status': main.REPORT_STATUS_RESOLVED})
+
+    reports.after_read = resolve_concurrently
+    result = main._apply_status_changes(['pending', 'legacy'], main.REPORT_STATUS_IN_REVIEW)
+
+    # En el reintento, Resuelto -> En revisión ya no es una transición válida
+    assert result == {'updated': [('legacy', 2, None)], 'skipped': ['pending']}
+    assert reports.docs['pending']['status'] == main.REPORT_STATUS_RESOLVED
+
+
+def test_chunk_is_skipped_after_repeated_conflicts(reports):
+    reports.after_read = lambda db: db.write('legacy', {})
+    result = main._apply_status_changes(['pending', 'legacy'], main.REPORT_STATUS_IN_REVIEW)
+
+    assert result == {'updated': [], 'skipped': ['pending', 'legacy']}
+    assert reports.commits == []
+    assert reports.docs['pending']['status'] == main.REPORT_STATUS_PENDING
+
+
+def test_changes_are_written_in_batches_of_500(monkeypatch):
+    db = FakeReports({f"r{index:04d}": {'user_id': index} for index in range(1100)})
+    monkeypatch.setattr(main, 'db', db)
+
+    result = main._apply_status_changes(sorted(db.docs), main.REPORT_STATUS_RESOLVED)
+
+    assert db.commits == [500, 500, 100]
+    assert len(result['updated']) == 1100
+
+
+def test_update_report_statuses_notifies_each_owner(reports, monkeypatch):
+    notices = []
+    monkeypatch.setattr(main, 'status_notifier', SimpleNamespace(notify=lambda *args: notices.append(args)))
+
+    result = asyncio.run(main.update_report_statuses(['pending', 'review'], main.REPORT_STATUS_RESOLVED))
+
+    assert result == {'updated': ['pending', 'review'], 'skipped': []}
+    assert notices == [(1, 'pending', main.REPORT_STATUS_RESOLVED, 'en'),
+                       (1, 'review', main.REPORT_STATUS_RESOLVED, None)]
+
+
+class FlakyBot:
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        failure = self.failures.get(chat_id)
+        if failure:
+            self.failures[chat_id] = failure[1:]
+            raise failure[0]
+        self.sent.append(chat_id)
+
+
+def test_outbound_queue_survives_errors_and_retries_after():
+    bot = FlakyBot({
+        1: [RuntimeError("unexpected")],
+        2: [BadRequest("chat not found")],
+        3: [RetryAfter(0), RetryAfter(0)],
+        4: [RetryAfter(0)] * main.OUTBOUND_MAX_ATTEMPTS,
+    })
+
+    async def scenario():
+        outbound = main.OutboundQueue(rate_per_second=1000)
+        outbound.start(bot)
+        for chat_id in (1, 2, 3, 4, 5):
+            outbound.put(chat_id, "hola")
+        await outbound.stop(timeout=2)
+
+    asyncio.run(scenario())
+    # 1 y 2 fallan sin reintento, 3 sale al tercer intento, 4 se descarta y 5 sigue saliendo
+    assert bot.sent == [3, 5]
+
+
+def test_status_notifier_coalesces_changes_per_user():
+    class Outbound:
+        def __init__(self):
+            self.sent = []
+
+        def put(self, chat_id, text):
+            self.sent.append((chat_id, text))
+
+    outbound = Outbound()
+
+    async def scenario():
+        notifier = main.StatusNotifier(outbound, window=60)
+        notifier.notify(1, 'a', main.REPORT_STATUS_IN_REVIEW, 'en')
+        notifier.notify(1, 'b', main.REPORT_STATUS_RESOLVED, 'en')
+        notifier.notify(2, 'c', main.REPORT_STATUS_RESOLVED, 'es')
+        notifier.flush_all()
+
+    asyncio.run(scenario())
+
+    assert [chat_id for chat_id, _ in outbound.sent] == [1, 2]
+    many, one = outbound.sent[0][1], outbound.sent[1][1]
+    assert many == main.messages.render('en', 'status_changed_many', count=2, lines='\n'.join([
+        f"- a: {main.messages.status('en', main.REPORT_STATUS_IN_REVIEW)}",
+        f"- b: {main.messages.status('en', main.REPORT_STATUS_RESOLVED)}",
+    ]))
+    assert one == main.messages.render('es', 'status_changed_one', report_id='c',
+                                       status=main.messages.status('es', main.REPORT_STATUS_RESOLVED))
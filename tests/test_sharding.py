@@ -0,0 +1,147 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+NODES = ["http://a", "http://b", "http://c"]
+
+
+def test_ring_is_deterministic_and_uses_every_node():
+    ring, again = main.HashRing(NODES), main.HashRing(list(reversed(NODES)))
+    owners = [ring.owner(chat_id) for chat_id in range(3000)]
+    assert owners == [again.owner(chat_id) for chat_id in range(3000)]
+    assert set(owners) == set(NODES)
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = main.HashRing(NODES)
+    after = main.HashRing(NODES + ["http://d"])
+    moved = [chat_id for chat_id in range(4000) if before.owner(chat_id) != after.owner(chat_id)]
+
+    assert all(after.owner(chat_id) == "http://d" for chat_id in moved)
+    # Se espera que se mueva ~1/4 de las claves, no una redistribución completa
+    assert 0.1 < len(moved) / 4000 < 0.4
+
+
+def test_extract_chat_id_from_common_updates():
+    assert main.extract_chat_id({'update_id': 1, 'message': {'chat': {'id': 10}, 'from': {'id': 20}}}) == 10
+    assert main.extract_chat_id({
+        'update_id': 2,
+        'callback_query': {'from': {'id': 20}, 'message': {'chat': {'id': 10}}},
+    }) == 10
+    assert main.extract_chat_id({'update_id': 3, 'poll_answer': {'user': {'id': 30}}}) == 30
+    assert main.extract_chat_id({'update_id': 4, 'poll': {'id': 'p'}}) is None
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return main.MemoryStateStore()
+    return main.SQLiteStateStore(str(tmp_path / "state.sqlite3"))
+
+
+def test_forwarded_update_log_drops_repeats_until_ttl(store):
+    log = main.ForwardedUpdateLog(store, ttl=60)
+    assert log.first_seen("100")
+    assert not log.first_seen("100")
+    assert log.first_seen("101")
+
+    expired = main.ForwardedUpdateLog(store, ttl=-1)
+    assert expired.first_seen("200")
+    assert expired.first_seen("200")
+
+
+def test_forgotten_update_is_accepted_again(store):
+    log = main.ForwardedUpdateLog(store, ttl=60)
+    assert log.first_seen("100")
+    log.forget("100")
+    assert log.first_seen("100")
+
+
+def test_prune_deletes_only_expired_entries(store):
+    store.set(main.ForwardedUpdateLog.NAMESPACE, "old", True, expires_at=main.monotonic() - 1)
+    store.set(main.ForwardedUpdateLog.NAMESPACE, "new", True, expires_at=main.monotonic() + 60)
+    store.set('conversation:test', "[1, 1]", 0)
+
+    assert store.prune(main.ForwardedUpdateLog.NAMESPACE) == 1
+    assert store.keys(main.ForwardedUpdateLog.NAMESPACE) == ["new"]
+    assert store.keys('conversation:test') == ["[1, 1]"]
+
+
+def test_forwarded_update_log_prunes_periodically(store, monkeypatch):
+    log = main.ForwardedUpdateLog(store, ttl=-1)
+    monkeypatch.setattr(log, 'PRUNE_EVERY', 3)
+    for update_id in range(3):
+        log.first_seen(str(update_id))
+    # La tercera llamada purga las dos anteriores antes de guardar la suya
+    assert store.prune(log.NAMESPACE) == 1
+
+
+def forward_with(handler):
+    router = main.ShardRouter(NODES, "http://a")
+    router._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def scenario():
+        try:
+            return await router.forward("http://b", b'{"update_id": 7}', 7)
+        finally:
+            await router.close()
+
+    return asyncio.run(scenario())
+
+
+def test_forward_sends_update_id_and_reports_delivery():
+    seen = {}
+
+    def handler(request):
+        seen.update(request.headers)
+        return httpx.Response(200, json={"status": "ok"})
+
+    assert forward_with(handler) == main.FORWARD_DELIVERED
+    assert seen[main.SHARD_UPDATE_ID_HEADER.lower()] == "7"
+
+
+def test_forward_only_falls_back_when_owner_is_unreachable():
+    def refuse(request):
+        raise httpx.ConnectError("refused", request=request)
+
+    def slow(request):
+        raise httpx.ReadTimeout("timeout", request=request)
+
+    assert forward_with(refuse) == main.FORWARD_UNREACHABLE
+    assert forward_with(slow) == main.FORWARD_FAILED
+    assert forward_with(lambda request: httpx.Response(502)) == main.FORWARD_FAILED
+
+
+def test_owner_accepts_the_retry_of_an_update_that_failed(monkeypatch):
+    calls = []
+
+    async def process_update(update):
+        calls.append(update.update_id)
+        if len(calls) == 1:
+            raise RuntimeError("Firestore unavailable")
+
+    coordinator = main.ShutdownCoordinator(drain_timeout=1, grace_period=0)
+    coordinator.mark_ready()
+    monkeypatch.setattr(main, 'shutdown_coordinator', coordinator)
+    monkeypatch.setattr(main, 'application', SimpleNamespace(bot=None, process_update=process_update))
+    monkeypatch.setattr(main, 'update_prefilter', None)
+    monkeypatch.setattr(main, 'forwarded_updates', main.ForwardedUpdateLog(main.MemoryStateStore(), 60))
+
+    client = TestClient(main.app)
+    body = json.dumps({'update_id': 9, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'hola',
+    }})
+    headers = {main.SHARD_FORWARDED_HEADER: 'other', main.SHARD_UPDATE_ID_HEADER: '9'}
+
+    assert client.post("/", content=body, headers=headers).status_code == 500
+    retry = client.post("/", content=body, headers=headers)
+    assert retry.json() == {"status": "ok"}
+    assert client.post("/", content=body, headers=headers).json() == {"status": "duplicate"}
+    assert calls == [9, 9]
@@ -0,0 +1,73 @@
+import asyncio
+
+import main
+
+
+def test_phases_gate_new_webhooks():
+    coordinator = main.ShutdownCoordinator(drain_timeout=1, grace_period=0)
+    assert coordinator.phase == main.ShutdownCoordinator.STARTING
+    assert not coordinator.accepting and not coordinator.stopping
+
+    coordinator.mark_ready()
+    assert coordinator.accepting and not coordinator.stopping
+
+    async def drain():
+        coordinator.begin_drain()
+        await coordinator.wait_idle()
+
+    asyncio.run(drain())
+    assert coordinator.phase == main.ShutdownCoordinator.DRAINING
+    assert not coordinator.accepting and coordinator.stopping
+
+    coordinator.mark_stopped()
+    assert coordinator.phase == main.ShutdownCoordinator.STOPPED and coordinator.stopping
+
+
+def test_drain_runs_callbacks_and_waits_for_tracked_tasks():
+    coordinator = main.ShutdownCoordinator(drain_timeout=2, grace_period=0)
+    coordinator.mark_ready()
+    events = []
+
+    async def flush():
+        events.append('flush')
+
+    async def failing_flush():
+        raise RuntimeError("Firestore unavailable")
+
+    async def request():
+        await asyncio.sleep(0.05)
+        events.append('request')
+
+    async def scenario():
+        coordinator.on_drain(failing_flush)
+        coordinator.on_drain(flush)
+        coordinator.track(asyncio.create_task(request()))
+        coordinator.begin_drain()
+        # Una segunda señal no reinicia el drenaje
+        coordinator.begin_drain()
+        await coordinator.wait_idle()
+
+    asyncio.run(scenario())
+    assert sorted(events) == ['flush', 'request']
+
+
+def test_wait_idle_gives_up_at_the_deadline():
+    coordinator = main.ShutdownCoordinator(drain_timeout=0.1, grace_period=0)
+
+    async def scenario():
+        stuck = asyncio.create_task(asyncio.sleep(10))
+        coordinator.track(stuck)
+        coordinator.begin_drain()
+        started = main.monotonic()
+        await coordinator.wait_idle()
+        elapsed = main.monotonic() - started
+        stuck.cancel()
+        return elapsed
+
+    assert asyncio.run(scenario()) < 1
+    assert coordinator.remaining() == 0
+
+
+def test_remaining_is_the_full_budget_before_draining():
+    coordinator = main.ShutdownCoordinator(drain_timeout=8, grace_period=0)
+    assert coordinator.remaining() == 8
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import sqlite3
+
+import pytest
+from telegram import Update
+from telegram.request import BaseRequest
+from telegram.ext import (
+    ApplicationBuilder, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters,
+)
+
+import main
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return main.MemoryStateStore()
+    return main.SQLiteStateStore(str(tmp_path / "state.sqlite3"))
+
+
+def test_store_basic_operations(store):
+    assert store.get('ns', 'a') is None
+    store.set('ns', 'a', {'x': 1})
+    assert store.get('ns', 'a') == {'x': 1}
+    assert store.keys('ns') == ['a']
+    assert store.keys('other') == []
+
+    assert not store.add_if_absent('ns', 'a', 2)
+    assert store.add_if_absent('ns', 'b', 2)
+    assert sorted(store.keys('ns')) == ['a', 'b']
+
+    assert store.delete('ns', 'a')
+    assert not store.delete('ns', 'a')
+    assert store.get('ns', 'a', 'default') == 'default'
+
+
+def test_user_data_writes_one_entry_per_key(store):
+    user_data = main.StoredUserData(store, 42)
+    user_data['name'] = 'Ana'
+    user_data['email'] = 'ana@example.com'
+
+    assert sorted(store.keys('user_data:42')) == ['"email"', '"name"']
+    assert dict(main.StoredUserData(store, 42)) == {'name': 'Ana', 'email': 'ana@example.com'}
+    assert main.StoredUserData(store, 7).get('name') is None
+
+    del user_data['name']
+    with pytest.raises(KeyError):
+        del user_data['name']
+    assert dict(user_data) == {'email': 'ana@example.com'}
+
+
+def test_stored_conversations_use_tuple_keys(store):
+    conversations = main.StoredConversations(store, 'conversation:test')
+    conversations[(1, 2)] = 3
+    assert (1, 2) in conversations
+    assert conversations.get((1, 2)) == 3
+    assert list(conversations) == [(1, 2)]
+    assert conversations.pop((1, 2)) == 3
+    assert len(conversations) == 0
+
+
+def test_sqlite_store_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    first, second = main.SQLiteStateStore(path), main.SQLiteStateStore(path)
+    first.set('ns', 'a', 1)
+    assert second.get('ns', 'a') == 1
+    assert not second.add_if_absent('ns', 'a', 2)
+
+
+def test_sqlite_store_fails_fast_when_another_writer_holds_the_lock(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    store = main.SQLiteStateStore(path, busy_timeout=0.05)
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        # Las lecturas no esperan (WAL); las escrituras fallan enseguida
+        assert store.get('ns', 'a') is None
+        with pytest.raises(sqlite3.OperationalError):
+            store.set('ns', 'a', 1)
+    finally:
+        blocker.execute("ROLLBACK")
+        blocker.close()
+
+
+NAME = 0
+
+
+class GetMeRequest(BaseRequest):
+    """Responde a getMe sin red, para poder inicializar la Application."""
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        bot = {'id': 1, 'is_bot': True, 'first_name': 'ReporteBot', 'username': 'ReporteBot'}
+        return 200, json.dumps({'ok': True, 'result': bot}).encode()
+
+
+async def ask_name(update, context):
+    context.user_data['started_by'] = context.application.bot_data['label']
+    return NAME
+
+
+async def save_name(update, context):
+    context.user_data['name'] = update.message.text
+    context.application.bot_data['finished'] = dict(context.user_data)
+    return ConversationHandler.END
+
+
+def build_worker(label):
+    application = (
+        ApplicationBuilder()
+        .token("1:test")
+        .updater(None)
+        .request(GetMeRequest())
+        .get_updates_request(GetMeRequest())
+        .context_types(ContextTypes(context=main.SharedCallbackContext))
+        .build()
+    )
+    application.bot_data['label'] = label
+    application.add_handler(main.SharedConversationHandler(
+        name='test_register',
+        entry_points=[CommandHandler('register', ask_name)],
+        states={NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_name)]},
+        fallbacks=[],
+    ))
+    return application
+
+
+def message(application, update_id, text):
+    payload = {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': 5, 'type': 'private'}, 'from': {'id': 5, 'is_bot': False, 'first_name': 'Ana'},
+    }
+    if text.startswith('/'):
+        payload['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return Update.de_json({'update_id': update_id, 'message': payload}, application.bot)
+
+
+def test_conversation_started_on_one_worker_finishes_on_another(monkeypatch, tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    # Cada worker es un proceso con su propia conexión al mismo fichero
+    monkeypatch.setattr(main, 'state_store', main.SQLiteStateStore(path))
+    first = build_worker('first')
+    monkeypatch.setattr(main, 'state_store', main.SQLiteStateStore(path))
+    second = build_worker('second')
+
+    async def scenario():
+        await first.initialize()
+        await second.initialize()
+        await first.process_update(message(first, 1, '/register'))
+        await second.process_update(message(second, 2, 'Ana'))
+        # La conversación ya ha terminado también para el primer worker
+        await first.process_update(message(first, 3, 'Otra'))
+
+    asyncio.run(scenario())
+
+    assert second.bot_data['finished'] == {'started_by': 'first', 'name': 'Ana'}
+    assert 'finished' not in first.bot_data
+    assert main.state_store.keys('conversation:test_register') == []
@@ -0,0 +1,47 @@
+from datetime import date, datetime, time, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def madrid(monkeypatch):
+    monkeypatch.setattr(main, 'LOCAL_TIMEZONE', ZoneInfo("Europe/Madrid"))
+
+
+def test_parse_date_accepts_iso_dates():
+    assert main.parse_date("2025-10-27") == date(2025, 10, 27)
+    assert main.parse_date(" 2024-02-29 ") == date(2024, 2, 29)
+
+
+@pytest.mark.parametrize("text", ["2025-1-5", "27/10/2025", "2025-02-30", "20251027", "2025-10-27T10:00", ""])
+def test_parse_date_rejects_other_formats(text):
+    with pytest.raises(ValueError):
+        main.parse_date(text)
+
+
+def test_parse_time_accepts_24h_times():
+    assert main.parse_time("18:30") == time(18, 30)
+    assert main.parse_time("7:05") == time(7, 5)
+    assert main.parse_time("00:00") == time(0, 0)
+
+
+@pytest.mark.parametrize("text", ["25:00", "18:60", "18.30", "6pm", "18:3", "18:30:00", ""])
+def test_parse_time_rejects_other_formats(text):
+    with pytest.raises(ValueError):
+        main.parse_time(text)
+
+
+def test_local_to_utc_follows_daylight_saving():
+    # Horario de verano (UTC+2) y de invierno (UTC+1), antes y después del 26-10-2025
+    assert main.local_to_utc(date(2025, 10, 25), time(18, 30)) == datetime(2025, 10, 25, 16, 30, tzinfo=timezone.utc)
+    assert main.local_to_utc(date(2025, 10, 27), time(18, 30)) == datetime(2025, 10, 27, 17, 30, tzinfo=timezone.utc)
+
+
+def test_to_local_round_trips_utc():
+    moment = datetime(2025, 7, 1, 10, 0, tzinfo=timezone.utc)
+    local = main.to_local(moment)
+    assert local.hour == 12
+    assert local == moment